@@ -2,7 +2,6 @@ import pandas as pd
 import numpy as np
 import os
 import matplotlib.pyplot as plt
-import itertools
 # from utilities.Repository import Repository
 # from utilities.utilities import load_api_dict
 import multiprocessing
@@ -15,6 +14,8 @@ output_filepath = '../data/results/stages_per_file.csv'
 fig_filepath = '../data/results/stages_per_file.png'
 #This is where the cloned repos are stored
 local_path_main = '/mnt/volume1/mlexpmining/cloned_repos'
+#Analysis results of files are cached here by content and reused across repositories and runs
+analysis_cache_path = '../data/analysis_cache.sqlite'
 N_PROCESSES = 4
 FIGSIZE=(12,6)
 WSPACE=0.5
@@ -33,40 +34,24 @@ def get_stage_count(repo):
         5:0,
         6:0
     }
-    Repo=Repository(local_dir=local_path_main+'/'+repo['local_folder'])
+    Repo=Repository(local_dir=local_path_main+'/'+repo['local_folder'],analysis_cache=analysis_cache_path)
     stages_to_functions, functions_to_stages = load_api_dict()
-    stages_to_files=Repo.get_ml_stages(stages_to_functions,functions_to_stages)
-    #Create a list of files implementing an ml stage
-    file_list=[]
-    #Convert the dictionary into a list of files
-    for v in stages_to_files.values():
-        file_list+=v
-    #Count occurences of all file names in the list to get the number of ml stages implemented by the file
-    for file in set(file_list):
-        n_stages=file_list.count(file)
-        stage_count[n_stages]+=1
+    stage_map=Repo.get_ml_stages(stages_to_functions,functions_to_stages)
+    #Count the files by the number of ml stages they implement (set bits of their stage bitmask)
+    for n_stages,count in enumerate(stage_map.stage_count()):
+        if n_stages>0:
+            stage_count[n_stages]+=int(count)
     return stage_count
 
 def get_stage_combination(item):
     repo=item[1]
-    Repo=Repository(local_dir=local_path_main+'/'+repo['local_folder'])
+    Repo=Repository(local_dir=local_path_main+'/'+repo['local_folder'],analysis_cache=analysis_cache_path)
     stages_to_functions, functions_to_stages = load_api_dict()
-    stages_to_files=Repo.get_ml_stages(stages_to_functions,functions_to_stages)
-    #Invert the dictionary to get the stages implemented in each file
-    file_list=set(itertools.chain.from_iterable(stages_to_files.values()))
-    files_to_stages={i:[] for i in file_list}
-    for k, v in stages_to_files.items():
-        for i in v:
-            files_to_stages[i].append(k)
-    #Create a list of all stage combinations
-    combinations_list=[]
-    for k,v in files_to_stages.items():
-        combinations_list.append(' '.join(v))
-    combinations_set=set(combinations_list)
-    #Count the occurences of each combination
+    stage_map=Repo.get_ml_stages(stages_to_functions,functions_to_stages)
+    #Count the occurences of each combination of stages, i.e. of each stage bitmask
     combinations_count={}
-    for c in combinations_set:
-        combinations_count[c]=combinations_list.count(c)
+    for stages,count in stage_map.combinations().items():
+        combinations_count[' '.join(stages)]=count
 
     return combinations_count
 
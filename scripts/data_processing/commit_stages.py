@@ -3,11 +3,15 @@ import pandas as pd
 import os
 from datetime import datetime
 import multiprocessing
+import shutil
 import tqdm
 from functools import partial
 
 from scripts.utilities.Repository import Repository
-from scripts.utilities.utilities import load_api_dict
+from scripts.utilities.parallel import NestablePool, CoreBudget
+from scripts.utilities.Watermark import Watermark
+from scripts.utilities.StageLineage import StageLineage
+from scripts.utilities.utilities import load_api_dict, rows_to_csv
 
 """
 Determine which ml stages were modified in each commit.
@@ -18,36 +22,134 @@ Requires that the repos have already been cloned and stored locally.
 #Specify where you stored your local copies of the subject repos
 CLONED_REPO_DIR = '/mnt/volume1/mlexpmining/cloned_repos'
 OUTPUT_DIR = "data/commit_stages"
+# Analysis results of files are cached here by content and reused across repositories, revisions and runs
+ANALYSIS_CACHE = "data/analysis_cache.sqlite"
+# Watermarks of the incremental mode: last mined commit and stages of the files of each repository
+WATERMARK_DIR = "data/commit_stages_watermarks"
+# Stage transitions of each source file across the history (utilities/StageLineage.py), one .npz file per repository
+LINEAGE_DIR = "data/commit_stages_lineage"
+TRACK_LINEAGE = True
 
 N_PROCESSES = 32
+# Repositories with long histories are split into contiguous ranges of commits mined by up to this many processes
+# (see Repository.get_commit_stages), so that they do not keep one worker busy long after the others are idle.
+# Ranges only run in parallel on cores that no other worker uses (core_budget).
+SHARD_PROCESSES = 8
+# Additional per-commit metrics computed in the same pass (see utilities/commit_metrics.py), e.g.
+# ('lines_per_stage', 'n_ml_files', 'author', 'notebook_only'). Their columns follow the stage columns.
+COMMIT_METRICS = ()
+# Write a commit-graph and a multi-pack-index (Repository.maintain_history) before mining. Fresh clones have neither,
+# so each revision walk parses every commit object. Repositories that already have a commit-graph are skipped.
+MAINTAIN_HISTORY = True
+# CSV file to which the time of a revision walk before and after the maintenance is appended, None to skip the timing
+MAINTENANCE_LOG = None
+# Mine all local and remote-tracking branches instead of HEAD, rows get the column 'branches'. Incremental mode follows
+# HEAD and is not used then.
+ALL_BRANCHES = False
+# Estimates of the share of commits changing each stage for histories that are only sampled (get_commit_stages_sampled)
+SAMPLED_OUTPUT_DIR = "data/commit_stages_sampled"
+# Half width of the 95% confidence intervals of the sampled estimates
+SAMPLE_MARGIN = 0.02
 
 # Storing information about skipped repos
 skipped = multiprocessing.Value('i', 0)
+# Cores used by the workers of parallel_run and the ranges they mine in parallel
+core_budget = CoreBudget()
 
 
-def get_commit_stages(repo_name, functions_to_stages, stages_to_functions):
-    """Get the results for one repository and save it. Assumes that repos are stored locally."""
+def get_commit_stages(repo_name, functions_to_stages, stages_to_functions, incremental=False, n_processes=1):
+    """
+    Get the results for one repository and save it. Assumes that repos are stored locally.
+    In incremental mode only the commits since the last run are mined and appended to the existing results.
+    n_processes is the number of processes mining ranges of long histories.
+    """
 
     # Determine the full absolute filepath from the repo name
     repo_filepath = os.path.join(CLONED_REPO_DIR, repo_name)
     print(repo_filepath)
     if not os.path.exists(repo_filepath):
         return
+    core_budget.take(1)
     try:
         # Get results
-        repo = Repository(local_dir=repo_filepath)
-        results = repo.get_commit_stages(
-            functions_to_stages, stages_to_functions)
-        # Save results
+        repo = Repository(local_dir=repo_filepath,
+                          analysis_cache=ANALYSIS_CACHE)
         repo_name = repo_filepath.split('/')[-1]
         result_dir = os.path.join(OUTPUT_DIR, repo_name)
-        results.to_csv(result_dir, index=False)
+        watermark_path = os.path.join(WATERMARK_DIR, repo_name + '.json')
+        watermark = None
+        if incremental and not ALL_BRANCHES and os.path.exists(result_dir):
+            watermark = Watermark.load(watermark_path)
+        lineage_path = os.path.join(LINEAGE_DIR, repo_name + '.npz')
+        lineage = None
+        if TRACK_LINEAGE:
+            # The lineage of the last run is continued in incremental mode
+            lineage = StageLineage.load(lineage_path) if watermark is not None else None
+            if lineage is None:
+                lineage = StageLineage(stages_to_functions)
+        if MAINTAIN_HISTORY:
+            repo.maintain_history(timing_log=MAINTENANCE_LOG)
+        # Rows are written in chunks while the history is mined, to a separate file until the run is done
+        rows = repo.iter_commit_stages(
+            functions_to_stages, stages_to_functions, watermark=watermark, n_processes=n_processes,
+            metrics=COMMIT_METRICS, lineage=lineage, all_branches=ALL_BRANCHES, core_budget=core_budget,
+            create_watermark=True)
+        part_path = result_dir + '.part'
+        n_rows = rows_to_csv(rows, part_path)
+        # Save results
+        if repo.incremental:
+            if repo.watermark is None:
+                # The new commits were cut by the time budget, keep the old results and watermark
+                os.remove(part_path)
+                return
+            if n_rows:
+                append_csv(part_path, result_dir)
+            os.remove(part_path)
+        else:
+            os.replace(part_path, result_dir)
+        if repo.watermark is not None and lineage is not None:
+            os.makedirs(LINEAGE_DIR, exist_ok=True)
+            lineage.save(lineage_path)
+        if repo.watermark is not None:
+            repo.watermark.save(watermark_path)
     except Exception as e:
         # Ignore errors
         print(e)
+    finally:
+        core_budget.release(1)
     # return results, result_dir
 
 
+def append_csv(part_path, result_dir):
+    """Appends the rows of a CSV file to another CSV file with the same columns, without the header."""
+    with open(part_path, 'rb') as source, open(result_dir, 'ab') as target:
+        source.readline()
+        shutil.copyfileobj(source, target)
+
+
+def get_commit_stages_sampled(repo_name, functions_to_stages, stages_to_functions):
+    """
+    Like get_commit_stages, but only mines a random sample of the commits, stratified by time, and saves the estimated
+    proportion of commits changing each stage with its confidence interval. For repositories with very long histories.
+    """
+    repo_filepath = os.path.join(CLONED_REPO_DIR, repo_name)
+    if not os.path.exists(repo_filepath):
+        return
+    try:
+        repo = Repository(local_dir=repo_filepath,
+                          analysis_cache=ANALYSIS_CACHE)
+        if MAINTAIN_HISTORY:
+            repo.maintain_history(timing_log=MAINTENANCE_LOG)
+        sampled = repo.sample_commit_stages(functions_to_stages, stages_to_functions, margin=SAMPLE_MARGIN)
+        estimates = sampled.estimates.rename_axis('stage').reset_index()
+        estimates['n_commits'] = sampled.n_commits
+        estimates['sample_size'] = sampled.sample_size
+        os.makedirs(SAMPLED_OUTPUT_DIR, exist_ok=True)
+        estimates.to_csv(os.path.join(SAMPLED_OUTPUT_DIR, repo_name), index=False)
+    except Exception as e:
+        print(e)
+
+
 def single_run():
     """Get commit stages for all repos that are stored locally. Uses single process."""
 
@@ -58,22 +160,26 @@ def single_run():
         print(i)
         # repo_path = repo_dir.path
         results = get_commit_stages(repo_name, functions_to_stages,
-                                    stages_to_functions.keys())
+                                    list(stages_to_functions))
         print(results)
 
 
-def parallel_run():
-    """Get commit stages for all repos that are stored locally. Uses multiple processes."""
+def parallel_run(incremental=False):
+    """
+    Get commit stages for all repos that are stored locally. Uses multiple processes.
+    With incremental=True only the commits added since the last run are mined, e.g. after refreshing the clones.
+    """
 
     start_time = datetime.now()
     # Load data
     stages_to_functions, functions_to_stages = load_api_dict()
     repos = os.listdir(CLONED_REPO_DIR)
 
-    # Apply multiprocessing to obtain the results
-    pool = multiprocessing.Pool(processes=N_PROCESSES)
-    callback = partial(get_commit_stages, stages=stages_to_functions.keys(),
-                       functions_to_stages=functions_to_stages)
+    # Apply multiprocessing to obtain the results. The workers may mine long histories with processes of their own.
+    pool = NestablePool(processes=N_PROCESSES)
+    callback = partial(get_commit_stages, stages_to_functions=list(stages_to_functions),
+                       functions_to_stages=functions_to_stages, incremental=incremental,
+                       n_processes=SHARD_PROCESSES)
     for _ in tqdm.tqdm(pool.imap_unordered(callback, repos), total=len(repos)):
         pass
 
@@ -86,11 +192,14 @@ def get_commit_stages_remote(repo_name, functions_to_stages, stages_to_functions
     """Does the dame as get_commit_stages if repos are stored as tar files on an sftp server"""
 
     try:
-        repo = Repository(remote_compressed=repo_name)
-        results = repo.get_commit_stages(
-            functions_to_stages, stages_to_functions)
+        repo = Repository(remote_compressed=repo_name,
+                          analysis_cache=ANALYSIS_CACHE)
+        if MAINTAIN_HISTORY:
+            repo.maintain_history(timing_log=MAINTENANCE_LOG)
         result_dir = os.path.join(OUTPUT_DIR, repo_name)
-        results.to_csv(result_dir, index=False)
+        rows = repo.iter_commit_stages(
+            functions_to_stages, stages_to_functions, metrics=COMMIT_METRICS, all_branches=ALL_BRANCHES)
+        rows_to_csv(rows, result_dir)
     except Exception as e:
         print(e)
 
@@ -106,7 +215,7 @@ def remote_run():
     for i, repo_name in enumerate(repos):
         print(i)
         get_commit_stages_remote(repo_name, functions_to_stages,
-                                 stages_to_functions.keys())
+                                 list(stages_to_functions))
 
 
 def remote_run_parallel():
@@ -132,14 +241,20 @@ def remote_run_parallel():
 
 
 def get_commit_stages_clone(repo_url, functions_to_stages, stages_to_functions):
-    """Get the commit stages of a given repository cloning the repo directly from GitHub"""
+    """
+    Get the commit stages of a given repository cloning the repo directly from GitHub.
+    The clone is blobless and has no working tree, only the blobs of python files and notebooks are downloaded.
+    """
     try:
-        repo = Repository(remote_url=repo_url)
-        results = repo.get_commit_stages(
-            functions_to_stages, stages_to_functions)
+        repo = Repository(remote_url=repo_url, clone_filter='blob:none', checkout=False,
+                          analysis_cache=ANALYSIS_CACHE)
+        if MAINTAIN_HISTORY:
+            repo.maintain_history(timing_log=MAINTENANCE_LOG)
         repo_name = repo_url[19:].replace('/', '-')
         result_dir = os.path.join(OUTPUT_DIR, repo_name)
-        results.to_csv(result_dir, index=False)
+        rows = repo.iter_commit_stages(
+            functions_to_stages, stages_to_functions, metrics=COMMIT_METRICS, all_branches=ALL_BRANCHES)
+        rows_to_csv(rows, result_dir)
     except Exception as e:
         print(e)
 
@@ -153,7 +268,7 @@ def run_clone():
     for i, repo_url in enumerate(repos):
         print(i)
         get_commit_stages_clone(repo_url, functions_to_stages,
-                                stages_to_functions.keys())
+                                list(stages_to_functions))
 
 
 def run_clone_parallel():
@@ -12,7 +12,6 @@ from scripts.utilities.Repository import Repository
 
 """
 Filters out repositories that make no calls to scikit-learn/ tensorflow or cannot be cloned for analysis.
-Note: Make sure that nbconvert is installed! Otherwise no error will be raised, all notebook files are just skipped.
 """
 
 n_processes = 6
@@ -21,6 +20,8 @@ local_path_main = '/mnt/volume1/mlexpmining/cloned_repos'
 library = 'tensorflow'
 input_filepath = f'data/3-number_commits_filtered/{library}_dependents_14_02_2022.csv'
 output_filepath = f'data/4a-library_calls_filtered/{library}_14_02_2022.csv'
+# Analysis results of files are cached here by content and reused across repositories and runs
+analysis_cache_path = 'data/analysis_cache.sqlite'
 
 # Storing information about skipped and excluded repos
 excluded = multiprocessing.Value('i', 0)
@@ -69,15 +70,15 @@ def repo_uses_library(item, library: str):
     try:
         # repo=Repository(repo_url,local_path)
         if os.path.exists(local_path):
-            repo = Repository(repo_url, local_path)
+            repo = Repository(repo_url, local_path,
+                              analysis_cache=analysis_cache_path)
         else:
-            repo = Repository(repo_url)
-        imports = repo.get_all_imports()
-        # Check if there is at least 1 file that uses the specified library
-        for i in imports:
-            if i.startswith(library):
-                repo_line['uses_library'] = True
-                return repo_line
+            repo = Repository(
+                repo_url, analysis_cache=analysis_cache_path)
+        # Check if there is at least 1 file that uses the specified library. Stops at the first one.
+        if repo.uses_library(library):
+            repo_line['uses_library'] = True
+            return repo_line
         with excluded.get_lock():
             excluded.value += 1
         repo_line['uses_library'] = False
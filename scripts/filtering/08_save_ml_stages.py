@@ -7,6 +7,7 @@ from datetime import datetime
 
 from scripts.utilities.Repository import Repository
 from scripts.utilities.utilities import load_api_dict
+from scripts.utilities.parallel import NestablePool, cores_per_worker
 
 """
 Obtains the implemented ml stages for each repository and adds this information to the summary file.
@@ -18,18 +19,21 @@ n_processes = 4
 input_filepath = 'data/5-attributes/tensorflow.csv'
 output_filepath = 'data/5-attributes/tensorflow.csv'
 local_path_main = '/mnt/volume1/mlexpmining/cloned_repos'
+# Analysis results of files are cached here by content and reused across repositories and runs
+analysis_cache_path = 'data/analysis_cache.sqlite'
 
 # Storing information about skipped repos
 skipped = multiprocessing.Value('i', 0)
 
 
-def get_stage_list(item, stages_to_functions, functions_to_stages):
+def get_stage_list(item, stages_to_functions, functions_to_stages, n_file_processes=1):
     """
     Returns a list of ml stages implemented by a given repository
     Args:
         item:                   Tuple contnaining a row of the dataframe and an index. (Yielded by df.iterrows).
         stages_to_functions:    Dictionary mapping ml stages to functions
         functions_to_stages:    Inverse of stages_to_functions.
+        n_file_processes:       Number of processes used to analyze the files of one repository.
     Returns:
         pd.Series (Row of the dataframe with the list of ml stages added)
         None (If there was an error)
@@ -44,10 +48,11 @@ def get_stage_list(item, stages_to_functions, functions_to_stages):
 
     stage_list = []
     try:
-        repo = Repository(repo_url, local_path)
+        repo = Repository(repo_url, local_path,
+                          analysis_cache=analysis_cache_path)
         # Create a list of files for each workflow stage
         ml_stages = repo.get_ml_stages(
-            stages_to_functions, functions_to_stages)
+            stages_to_functions, functions_to_stages, n_file_processes)
         # Create a list of stages that are implemented in this project
         for k in ml_stages:
             # Check if there is at least one file corresponding to this stage
@@ -74,10 +79,12 @@ def parallel_run():
     columns = data_input.columns.to_list()+['ml_stages']
     data_output = pd.DataFrame(columns=columns)
 
-    # Apply multiprocessing to obtain the results
-    pool = multiprocessing.Pool(processes=n_processes)
+    # Apply multiprocessing to obtain the results. The workers may analyze the files of large repos in parallel,
+    # but only with their share of the cores.
+    pool = NestablePool(processes=n_processes)
     callback = partial(get_stage_list, stages_to_functions=stages_to_functions,
-                       functions_to_stages=functions_to_stages)
+                       functions_to_stages=functions_to_stages,
+                       n_file_processes=cores_per_worker(n_processes))
     for i in tqdm.tqdm(pool.imap_unordered(callback, data_input.iterrows()), total=len(data_input)):
         # results.append(i)
         data_output = data_output.append(i)
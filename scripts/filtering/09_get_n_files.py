@@ -2,6 +2,7 @@ import pandas as pd
 import os
 import multiprocessing
 import tqdm
+from scripts.utilities.RepoWalker import RepoWalker
 
 """Get the number of files for each repository and add results to the .csv file."""
 
@@ -26,8 +27,9 @@ def get_n_files(item):
     if not os.path.exists(local_path):
         return None
 
+    # Files in .git, virtual environments, installed packages and ignored files are not counted
     n_files = 0
-    for root, dirs, files in os.walk(local_path):
+    for root, dirs, files in RepoWalker(local_path).walk():
         n_files += len(files)
 
     line['n_files'] = n_files
@@ -5,10 +5,13 @@ import tqdm
 from functools import partial
 
 from scripts.utilities.Repository import Repository
+from scripts.utilities.parallel import NestablePool, cores_per_worker
 
 """Add the number of ml files for each project to the summary file."""
 
 CLONED_REPO_DIR = '/mnt/volume1/mlexpmining/cloned_repos'
+# Analysis results of files are cached here by content and reused across repositories and runs
+ANALYSIS_CACHE = 'data/analysis_cache.sqlite'
 summary_merged_path = 'data/5-attributes/tf_skl_merged.csv'
 output_path = 'data/5-attributes/tf_skl_merged.csv'
 
@@ -16,17 +19,19 @@ commit_stages_results = 'data/commit_stages'
 N_PROCESSES = 4
 
 
-def get_ml_files(item, stages_to_functions, functions_to_stages):
+def get_ml_files(item, stages_to_functions, functions_to_stages, n_file_processes=1):
     '''Calculate the number of ml files for a given repo.
     Args:
         item:   tuple (i, row). Returned by pd.DataFrame.iterrows(). Row is the relevant line from the summary file.
         stages_to_functions, functions_to_stages:   Mapping function calls to ml stages and vice versa.
+        n_file_processes:   Number of processes used to analyze the files of one repository.
     Returns:    The row with the numeber of ml stages added.
     '''
     row = item[1]
     path = os.path.join(CLONED_REPO_DIR, row['local_folder'])
-    repo = Repository(local_dir=path)
-    ml_files = repo.get_ml_files(stages_to_functions, functions_to_stages)
+    repo = Repository(local_dir=path, analysis_cache=ANALYSIS_CACHE)
+    ml_files = repo.get_ml_files(
+        stages_to_functions, functions_to_stages, n_file_processes)
     row['ml_files'] = len(ml_files)
     return row
 
@@ -72,10 +77,12 @@ def parallel_run():
     #  Loading the dependents of scikit-learn
     data_input = pd.read_csv(summary_merged_path)
 
-    # Execute the parallel filtering
-    pool = multiprocessing.Pool(processes=N_PROCESSES)
+    # Execute the parallel filtering. The workers may analyze the files of large repos in parallel,
+    # but only with their share of the cores.
+    pool = NestablePool(processes=N_PROCESSES)
     callback = partial(get_ml_files, stages_to_functions=stages_to_functions,
-                       functions_to_stages=functions_to_stages)
+                       functions_to_stages=functions_to_stages,
+                       n_file_processes=cores_per_worker(N_PROCESSES))
     results_list = []
     for i in tqdm.tqdm(pool.imap_unordered(callback, data_input.iterrows()), total=len(data_input)):
         results_list.append(i)
@@ -18,6 +18,8 @@ input_filepath = '../results_test/10-issues/tensorflow.csv'
 output_filepath = os.path.join(os.path.abspath(
     '../'), 'results_test/11-ml_stages/tensorflow.csv')
 local_path_main = '/mnt/volume1/mlexpmining/cloned_repos'
+# Analysis results of files are cached here by content and reused across repositories and runs
+analysis_cache_path = os.path.join(os.path.abspath('../'), 'data/analysis_cache.sqlite')
 
 # Storing information about skipped repos
 skipped = multiprocessing.Value('i', 0)
@@ -44,7 +46,8 @@ def get_stage_list(item, stages_to_functions, functions_to_stages):
 
     stage_list = []
     try:
-        repo = Repository(repo_url, local_path)
+        repo = Repository(repo_url, local_path,
+                          analysis_cache=analysis_cache_path)
         # Create a list of files for each workflow stage
         ml_stages = repo.get_ml_stages(
             stages_to_functions, functions_to_stages)
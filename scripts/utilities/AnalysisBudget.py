@@ -0,0 +1,127 @@
+import os
+import signal
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+"""
+Limits for the analysis of single files and whole repositories, so that one pathological file or repository cannot
+stall a worker. Everything that is cut is recorded as a skip record.
+"""
+
+# Default limits used by Repository
+MAX_FILE_BYTES = 20 * 1024 * 1024
+MAX_PARSE_SECONDS = 30
+# Number of bytes at the start of a file searched for null bytes to detect binary files
+BINARY_CHECK_BYTES = 8192
+
+
+class BudgetExceededError(Exception):
+    """Raised when a file is not analyzed because it exceeds a budget. reason is the reason of the skip record."""
+
+    def __init__(self, reason, message=None):
+        super().__init__(message or reason)
+        self.reason = reason
+
+
+class ParseTimeoutError(BudgetExceededError):
+    """Raised when parsing a single file takes longer than the parse time budget."""
+
+    def __init__(self):
+        super().__init__('parse_timeout')
+
+
+class AnalysisBudget:
+    """
+    Checks files against the budgets and keeps a list of skip records. Each record is a dictionary with the keys
+    'path', 'reason' ('binary', 'too_large', 'parse_timeout' or 'repo_timeout'), 'size' (bytes, None if unknown) and
+    'elapsed' (seconds spent before the cut, None if nothing was spent).
+    """
+
+    def __init__(self, max_file_bytes=MAX_FILE_BYTES, max_parse_seconds=MAX_PARSE_SECONDS, max_repo_seconds=None):
+        """
+        Args:
+            max_file_bytes:     Larger files are skipped without being read. None means no limit.
+            max_parse_seconds:  Parsing a file is aborted after this many seconds. Only enforced in the main thread of
+                                a process on platforms with SIGALRM. None means no limit.
+            max_repo_seconds:   The analysis of a repository stops after this many seconds. None means no limit.
+        """
+        self.max_file_bytes = max_file_bytes
+        self.max_parse_seconds = max_parse_seconds
+        self.max_repo_seconds = max_repo_seconds
+        self.skipped = []
+        self._repo_start = None
+
+    def skip(self, path, reason, size=None, elapsed=None):
+        """Adds a skip record."""
+        self.skipped.append({'path': path, 'reason': reason, 'size': size, 'elapsed': elapsed})
+
+    def _check(self, path, size, head):
+        """Raises BudgetExceededError and records the skip if the file is too large or looks binary."""
+        if self.max_file_bytes is not None and size > self.max_file_bytes:
+            self.skip(path, 'too_large', size)
+            raise BudgetExceededError('too_large')
+        if ('\0' if isinstance(head, str) else b'\0') in head:
+            self.skip(path, 'binary', size)
+            raise BudgetExceededError('binary')
+
+    def check_file(self, filepath):
+        """Checks a file on disk. Only the first BINARY_CHECK_BYTES bytes are read."""
+        size = os.path.getsize(filepath)
+        head = b''
+        if self.max_file_bytes is None or size <= self.max_file_bytes:
+            with open(filepath, 'rb') as f:
+                head = f.read(BINARY_CHECK_BYTES)
+        self._check(filepath, size, head)
+
+    def check_source(self, source, path=None):
+        """Checks the content (str or bytes) of a file, e.g. a version of a file in a commit."""
+        self._check(path, len(source), source[:BINARY_CHECK_BYTES])
+
+    @contextmanager
+    def parse_timer(self, path=None, size=None):
+        """
+        Context manager raising ParseTimeoutError if its body runs longer than max_parse_seconds. The timeout is
+        recorded as a skip record. Without SIGALRM, or outside the main thread, the body is not limited.
+        Signals are handled between python bytecodes, so a single call into ast.parse is not interrupted. Its duration
+        is bounded by FileAnalyzer.max_parse_bytes instead, the timeout then cuts the traversal of the tree.
+        """
+        if self.max_parse_seconds is None or not hasattr(signal, 'SIGALRM') \
+                or threading.current_thread() is not threading.main_thread():
+            yield
+            return
+
+        def on_alarm(signum, frame):
+            raise ParseTimeoutError()
+
+        start = time.monotonic()
+        previous_handler = signal.signal(signal.SIGALRM, on_alarm)
+        signal.setitimer(signal.ITIMER_REAL, self.max_parse_seconds)
+        try:
+            yield
+        except ParseTimeoutError:
+            self.skip(path, 'parse_timeout', size, time.monotonic() - start)
+            raise
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous_handler)
+
+    def start_repository(self):
+        """Starts the wall time budget of a repository."""
+        self._repo_start = time.monotonic()
+
+    def repo_elapsed(self):
+        """Returns the seconds since start_repository."""
+        return time.monotonic() - self._repo_start if self._repo_start is not None else 0.0
+
+    def repo_time_exceeded(self):
+        """Returns True if the wall time budget of the repository is used up."""
+        return self.max_repo_seconds is not None and self._repo_start is not None \
+            and self.repo_elapsed() > self.max_repo_seconds
+
+    def report(self):
+        """Returns a short summary of the skip records."""
+        reasons = Counter(record['reason'] for record in self.skipped)
+        return "Budget: {} files cut ({})".format(
+            len(self.skipped), ', '.join('{}: {}'.format(reason, n) for reason, n in sorted(reasons.items())) or 'none')
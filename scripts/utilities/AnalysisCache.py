@@ -0,0 +1,187 @@
+import hashlib
+import json
+import os
+import sqlite3
+from collections import Counter
+
+"""
+Persistent, content-addressed cache for the analysis results of single files.
+Entries are keyed by the git blob SHA of the file content, so identical files are only analyzed once across all
+repositories, all revisions and all runs. The cache is stored in an SQLite database that can be shared by the
+processes of a multiprocessing pool.
+The rows of Repository.get_commit_stages are cached by commit SHA as well, so commits shared by copied histories
+(re-uploads, mirrors, tutorial templates) are only mined once in the whole corpus.
+"""
+
+
+def git_blob_sha(data):
+    """Returns the git blob SHA (as used by git hash-object) of the given str, bytes or mmap."""
+    if isinstance(data, str):
+        data = data.encode('utf-8', errors='surrogateescape')
+    sha = hashlib.sha1(b'blob %d\0' % len(data))
+    sha.update(data)
+    return sha.hexdigest()
+
+
+def git_blob_sha_file(filepath, chunk_size=1 << 20):
+    """Returns the git blob SHA of a file. Reads the file in chunks, so memory use does not depend on its size."""
+    sha = hashlib.sha1(b'blob %d\0' % os.path.getsize(filepath))
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def dictionary_fingerprint(functions_to_stages: dict):
+    """Returns a short hash of the API dictionary. Stage results computed with another dictionary are not reused."""
+    items = json.dumps(sorted(functions_to_stages.items()))
+    return hashlib.sha1(items.encode('utf-8')).hexdigest()[:16]
+
+
+class AnalysisCache:
+    """
+    Stores the imports, call names and ml stages of files. Each field can be stored independently, missing fields are
+    returned as None. Stages are only returned if they were computed with the current API dictionary.
+    """
+
+    def __init__(self, path, functions_to_stages=None):
+        """
+        Args:
+            path:                   Location of the SQLite database. Created if it does not exist.
+            functions_to_stages:    API dictionary the stage results belong to. Can be set later with set_dictionary.
+        """
+        self.path = path
+        self.fingerprint = None
+        if functions_to_stages is not None:
+            self.set_dictionary(functions_to_stages)
+        self.hits = 0
+        self.misses = 0
+        self.commit_hits = 0
+        self.commit_misses = 0
+        # Connections cannot be shared between processes. Each process opens its own connection on first use.
+        self._conn = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        state['_pid'] = None
+        return state
+
+    def set_dictionary(self, functions_to_stages: dict):
+        """Sets the API dictionary used to validate stage results."""
+        self.fingerprint = dictionary_fingerprint(functions_to_stages)
+
+    def _connection(self):
+        """Returns the SQLite connection of the current process."""
+        if self._conn is None or self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # Autocommit mode keeps write transactions short. Concurrent writers wait for each other instead of failing.
+            conn = sqlite3.connect(self.path, timeout=300, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('''CREATE TABLE IF NOT EXISTS files (
+                                key TEXT PRIMARY KEY,
+                                imports TEXT,
+                                calls TEXT,
+                                stages TEXT,
+                                dictionary TEXT)''')
+            conn.execute('''CREATE TABLE IF NOT EXISTS commits (
+                                key TEXT PRIMARY KEY,
+                                row TEXT,
+                                dictionary TEXT)''')
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, key, field=None):
+        """
+        Returns the cached entry for a key.
+        Args:
+            key:    Git blob SHA of the file content.
+            field:  Field the caller needs ('imports', 'calls' or 'stages'). Only used to count hits and misses.
+        Returns:    Dictionary with the keys 'imports' (list), 'calls' (Counter) and 'stages' (list). Fields that are not
+                    cached, and stages computed with another dictionary, are None. Returns None if there is no entry.
+        """
+        row = self._connection().execute(
+            'SELECT imports, calls, stages, dictionary FROM files WHERE key=?', (key,)).fetchone()
+        entry = None
+        if row is not None:
+            imports, calls, stages, dictionary = row
+            entry = {
+                'imports': json.loads(imports) if imports is not None else None,
+                'calls': Counter(json.loads(calls)) if calls is not None else None,
+                'stages': json.loads(stages) if stages is not None and dictionary == self.fingerprint else None,
+            }
+        if entry is not None and (field is None or entry[field] is not None):
+            self.hits += 1
+        else:
+            self.misses += 1
+        return entry
+
+    def put(self, key, imports=None, calls=None, stages=None):
+        """Stores the given fields for a key. Fields that are None keep their previously cached value."""
+        if stages is not None and self.fingerprint is None:
+            raise ValueError("Stages can only be cached after the API dictionary has been set.")
+        self._connection().execute(
+            '''INSERT INTO files (key, imports, calls, stages, dictionary) VALUES (?, ?, ?, ?, ?)
+               ON CONFLICT(key) DO UPDATE SET
+                   imports=COALESCE(excluded.imports, imports),
+                   calls=COALESCE(excluded.calls, calls),
+                   stages=COALESCE(excluded.stages, stages),
+                   dictionary=COALESCE(excluded.dictionary, dictionary)''',
+            (key,
+             json.dumps(list(imports)) if imports is not None else None,
+             json.dumps(dict(calls)) if calls is not None else None,
+             json.dumps(list(stages)) if stages is not None else None,
+             self.fingerprint if stages is not None else None))
+
+    def get_commit(self, sha, variant='', stages=(), metrics=(), changes=False):
+        """
+        Returns the cached row of a commit as a dictionary {stage: number of files, 'time': ISO author date,
+        'metrics': {metric name: columns}, 'changes': changed source files}, or None if the commit is not cached, was
+        mined with another API dictionary or lacks one of the requested stages or metrics, or the changes.
+        Args:
+            sha:        Commit SHA.
+            variant:    Name of the options the row depends on, e.g. 'first-parent' for rows of merge commits that
+                        include the changes of the merged branch.
+            stages:     Stages the row has to contain.
+            metrics:    Names of the commit metrics the row has to contain.
+            changes:    Whether the row has to contain the changed source files, e.g. for a StageLineage. Rows
+                        cached before they were stored lack them.
+        """
+        row = self._connection().execute(
+            'SELECT row, dictionary FROM commits WHERE key=?', (sha + ':' + variant,)).fetchone()
+        if row is not None and row[1] == self.fingerprint:
+            row = json.loads(row[0])
+            cached_metrics = row.get('metrics', {})
+            if all(stage in row for stage in stages) and all(name in cached_metrics for name in metrics) \
+                    and (not changes or 'changes' in row):
+                self.commit_hits += 1
+                return row
+        self.commit_misses += 1
+        return None
+
+    def put_commit(self, sha, row, variant=''):
+        """
+        Stores the row {stage: number of files, 'time': author date (datetime), 'metrics': {metric name: columns},
+        'changes': [(old path, new path, stages of the new version or None), ...]} of a commit.
+        """
+        if self.fingerprint is None:
+            raise ValueError("Commits can only be cached after the API dictionary has been set.")
+        row = dict(row)
+        row['time'] = row['time'].isoformat()
+        self._connection().execute(
+            'INSERT OR REPLACE INTO commits (key, row, dictionary) VALUES (?, ?, ?)',
+            (sha + ':' + variant, json.dumps(row), self.fingerprint))
+
+    def report(self):
+        """Returns a short summary of the cache usage."""
+        total = self.hits + self.misses
+        report = "Analysis cache: {} hits, {} misses ({:.1%} hit rate)".format(
+            self.hits, self.misses, self.hits / total if total else 0.0)
+        if self.commit_hits or self.commit_misses:
+            report += ", {} of {} commits reused".format(self.commit_hits, self.commit_hits + self.commit_misses)
+        return report
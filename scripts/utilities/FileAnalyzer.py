@@ -0,0 +1,354 @@
+import ast
+import io
+import os
+import multiprocessing
+import tokenize
+from collections import Counter, namedtuple
+
+from scripts.utilities.StageClassifier import StageClassifier, extract_names, extract_names_from_tokens
+from scripts.utilities.Prefilter import LexicalPrefilter
+from scripts.utilities.AnalysisCache import git_blob_sha, git_blob_sha_file
+from scripts.utilities.AnalysisBudget import ParseTimeoutError
+from scripts.utilities.LRUCache import LRUCache
+from scripts.utilities.notebooks import get_code_cells, map_notebook
+from scripts.utilities.parallel import get_n_processes
+
+"""
+Analyzes single files with one parse: imports, called function names and ml stages are extracted together.
+"""
+
+# Result of the analysis of one file.
+#   imports:    List of imported modules.
+#   calls:      Counter of called function names.
+#   stages:     List of ml stages implemented by the file. None if no API dictionary was provided.
+FileAnalysis = namedtuple('FileAnalysis', ['imports', 'calls', 'stages'])
+
+# Sources larger than this are not parsed into a tree but tokenized as a stream
+MAX_PARSE_BYTES = 2 * 1024 * 1024
+# analyze_stages only starts a pool for at least this many files. Smaller repositories are analyzed faster than the
+# processes start.
+MIN_PARALLEL_FILES = 500
+# Number of analyses of notebook cells and of whole notebooks kept for reuse
+MAX_CELLS = 50000
+MAX_NOTEBOOKS = 10000
+
+# Analyzer used by the processes of a pool. Set once per process by _init_worker.
+_worker_analyzer = None
+
+
+def parse_python(source):
+    """Creates an abstract syntax tree from python source code given as str or utf-8 encoded bytes."""
+    if isinstance(source, (bytes, bytearray)):
+        source = source.decode('utf-8')
+    return ast.parse(source)
+
+
+def tokenize_source(source):
+    """Returns a token stream for python source code given as str or bytes."""
+    if isinstance(source, (bytes, bytearray)):
+        return tokenize.tokenize(io.BytesIO(source).readline)
+    return tokenize.generate_tokens(io.StringIO(source).readline)
+
+
+def _init_worker(analyzer):
+    global _worker_analyzer
+    _worker_analyzer = analyzer
+
+
+def _analyze_stages_worker(filepath):
+    """Determines the stages of one file in a pool process. Also returns the changes of the counters and the new skip records so they can be merged."""
+    counters = _worker_analyzer._get_counters()
+    n_skipped = len(_worker_analyzer.budget.skipped) if _worker_analyzer.budget is not None else 0
+    stages, error = _worker_analyzer.get_file_stages(filepath)
+    deltas = [new - old for new, old in zip(_worker_analyzer._get_counters(), counters)]
+    skipped = _worker_analyzer.budget.skipped[n_skipped:] if _worker_analyzer.budget is not None else []
+    return filepath, stages, error, deltas, skipped
+
+
+class FileAnalyzer:
+    """Parses files once and derives all results from the same tree. Results are shared through an optional AnalysisCache."""
+
+    def __init__(self, functions_to_stages=None, stages=None, analysis_cache=None, max_parse_bytes=MAX_PARSE_BYTES,
+                 budget=None):
+        """
+        Args:
+            functions_to_stages:    Dictionary mapping function names to ml stages. Without it no stages are determined.
+            stages:                 Ordered list of stages, passed on to the StageClassifier.
+            analysis_cache:         Optional AnalysisCache for results of files with the same content.
+            max_parse_bytes:        Larger sources are tokenized as a stream instead of being parsed into a tree.
+            budget:                 Optional AnalysisBudget. Files exceeding it raise BudgetExceededError, parses
+                                    running out of time fall back to the tokenizer.
+        """
+        self.functions_to_stages = functions_to_stages
+        self.max_parse_bytes = max_parse_bytes
+        self.budget = budget
+        # Number of sources analyzed with the tokenizer because they were too large or could not be parsed
+        self.tokenized = 0
+        # Analyses of notebook cells by the hash of their source, and of notebooks by the tuple of their cell hashes.
+        # Revisions of a notebook that only changed outputs reuse the whole result, other revisions reuse the
+        # results of their unchanged cells. Both are bounded, the least recently used analyses are evicted.
+        self._cells = LRUCache(MAX_CELLS)
+        self._notebooks = LRUCache(MAX_NOTEBOOKS)
+        self.cells_analyzed = 0
+        self.cells_reused = 0
+        self.notebooks_reused = 0
+        self.classifier = None
+        self.stage_prefilter = None
+        if functions_to_stages is not None:
+            self.classifier = StageClassifier(functions_to_stages, stages)
+            self.stage_prefilter = LexicalPrefilter(functions_to_stages)
+        self.analysis_cache = analysis_cache
+        if analysis_cache is not None and functions_to_stages is not None:
+            analysis_cache.set_dictionary(functions_to_stages)
+
+    def _get_stages(self, calls):
+        """Returns the list of stages implemented by the called functions, or None without an API dictionary."""
+        if self.classifier is None:
+            return None
+        return self.classifier.get_stages(self.classifier.classify_calls(calls))
+
+    def _empty_analysis(self):
+        return FileAnalysis([], Counter(), [] if self.classifier is not None else None)
+
+    def _lookup(self, key):
+        """Returns the cached FileAnalysis for a key, or None."""
+        entry = self.analysis_cache.get(key, 'calls')
+        if entry is None or entry['imports'] is None or entry['calls'] is None:
+            return None
+        stages = entry['stages']
+        if stages is None and self.classifier is not None:
+            # The API dictionary changed. Stages can be derived from the cached calls without parsing.
+            stages = self._get_stages(entry['calls'])
+            self.analysis_cache.put(key, stages=stages)
+        return FileAnalysis(entry['imports'], entry['calls'], stages)
+
+    def _parse_names(self, source, name=None):
+        """Returns (imports, calls) from the abstract syntax tree of the source, within the parse time budget."""
+        if self.budget is None:
+            return extract_names(parse_python(source))
+        with self.budget.parse_timer(name, len(source)):
+            return extract_names(parse_python(source))
+
+    def _extract(self, source, name=None):
+        """Returns (imports, calls) of python source code. Falls back to the tokenizer for large, unparseable or slow sources."""
+        if len(source) <= self.max_parse_bytes:
+            try:
+                return self._parse_names(source, name)
+            except (SyntaxError, ValueError, UnicodeDecodeError, RecursionError, MemoryError, ParseTimeoutError):
+                # Expect python 2 code, null bytes, wrong encodings and deeply nested generated code
+                pass
+        self.tokenized += 1
+        return extract_names_from_tokens(tokenize_source(source))
+
+    def analyze_source(self, source, convert=None, prefilter=None, name=None, key=None):
+        """
+        Returns the FileAnalysis of a source. Raises BudgetExceededError if the source exceeds the budget.
+        Args:
+            source:     Content of the file (str or bytes).
+            convert:    Optional function converting the source to python source code, e.g. for notebooks. Errors are
+                        passed on to the caller.
+            prefilter:  Optional LexicalPrefilter. Sources without a candidate name are not parsed and return an empty
+                        analysis, so only pass a prefilter if the result it guards is all that is needed.
+            name:       Path of the file, used in skip records.
+            key:        Git blob SHA of the source if it is already known, e.g. from git log. Computed otherwise.
+        Returns:        FileAnalysis, or None if convert returned None.
+        """
+        if self.budget is not None:
+            self.budget.check_source(source, name)
+        return self._analyze_data(source, convert, prefilter, name, key)
+
+    def _analyze_data(self, source, convert, prefilter, name, key=None):
+        """Analyzes a source that has passed the budget checks. See analyze_source."""
+        if prefilter is not None and not prefilter.matches(source):
+            return self._empty_analysis()
+
+        # Look up files with the same content
+        if self.analysis_cache is None:
+            key = None
+        else:
+            if key is None:
+                key = git_blob_sha(source)
+            analysis = self._lookup(key)
+            if analysis is not None:
+                return analysis
+
+        if convert is not None:
+            source = convert(source)
+            if source is None:
+                return None
+        imports, calls = self._extract(source, name)
+        analysis = FileAnalysis(imports, calls, self._get_stages(calls))
+        if key is not None:
+            self.analysis_cache.put(key, analysis.imports, analysis.calls, analysis.stages)
+        return analysis
+
+    def analyze_notebook(self, notebook, prefilter=None, name=None, key=None):
+        """
+        Returns the FileAnalysis of a Jupyter notebook, combined from the analyses of its code cells. Cells are
+        analyzed once per distinct source. Raises BudgetExceededError if the notebook exceeds the budget.
+        Args:
+            notebook:   Content of the .ipynb file (str, bytes or mmap).
+            prefilter:  Optional LexicalPrefilter, see analyze_source.
+            name:       Path of the notebook, used in skip records.
+            key:        Git blob SHA of the notebook if it is already known. Computed otherwise.
+        Returns:    FileAnalysis, or None if the notebook cannot be read.
+        """
+        if self.budget is not None:
+            self.budget.check_source(notebook, name)
+        return self._analyze_notebook_data(notebook, prefilter, name, key)
+
+    def _analyze_cell(self, source, key, name):
+        """Returns the FileAnalysis of one notebook cell with the given source hash."""
+        analysis = self._cells.get(key)
+        if analysis is not None:
+            self.cells_reused += 1
+            return analysis
+        imports, calls = self._extract(source, name)
+        analysis = FileAnalysis(imports, calls, None)
+        self._cells[key] = analysis
+        self.cells_analyzed += 1
+        return analysis
+
+    def _analyze_notebook_data(self, notebook, prefilter, name, key=None):
+        """Analyzes a notebook that has passed the budget checks. See analyze_notebook."""
+        if prefilter is not None and not prefilter.matches(notebook):
+            return self._empty_analysis()
+
+        # Look up notebooks with the same content
+        if self.analysis_cache is None:
+            key = None
+        else:
+            if key is None:
+                key = git_blob_sha(notebook)
+            analysis = self._lookup(key)
+            if analysis is not None:
+                return analysis
+
+        try:
+            sources = get_code_cells(notebook)
+        except ValueError:
+            return None
+        cell_keys = tuple(git_blob_sha(source) for source in sources)
+        analysis = self._notebooks.get(cell_keys)
+        if analysis is not None:
+            # Only outputs, execution counts or other cells than code cells changed
+            self.notebooks_reused += 1
+        else:
+            # The stages of the notebook are the union of the stages of its cells
+            imports = []
+            calls = Counter()
+            for source, cell_key in zip(sources, cell_keys):
+                cell = self._analyze_cell(source, cell_key, name)
+                imports += cell.imports
+                calls.update(cell.calls)
+            analysis = FileAnalysis(imports, calls, self._get_stages(calls))
+            self._notebooks[cell_keys] = analysis
+        if key is not None:
+            self.analysis_cache.put(key, analysis.imports, analysis.calls, analysis.stages)
+        return analysis
+
+    def report(self):
+        """Returns a short summary of the reuse of notebook results."""
+        return "Notebooks: {} revisions reused, {} cells analyzed, {} cells reused".format(
+            self.notebooks_reused, self.cells_analyzed, self.cells_reused)
+
+    def analyze_file(self, filepath, prefilter=None):
+        """
+        Returns the FileAnalysis of a python source file or Jupyter notebook. See analyze_source. Large python files are
+        streamed and never read into memory as a whole. Returns None if a notebook cannot be read.
+        """
+        if self.budget is not None:
+            # Cheap check before the file is read
+            self.budget.check_file(filepath)
+        if filepath.endswith('.ipynb'):
+            # Only the code cells are decoded, outputs stay on disk
+            with map_notebook(filepath) as data:
+                return self._analyze_notebook_data(data, prefilter, filepath)
+        if os.path.getsize(filepath) <= self.max_parse_bytes:
+            with open(filepath, 'rb') as source:
+                data = source.read()
+            return self._analyze_data(data, None, prefilter, filepath)
+
+        if prefilter is not None and not prefilter.matches_file(filepath):
+            return self._empty_analysis()
+        key = None
+        if self.analysis_cache is not None:
+            key = git_blob_sha_file(filepath)
+            analysis = self._lookup(key)
+            if analysis is not None:
+                return analysis
+        with open(filepath, 'rb') as source:
+            self.tokenized += 1
+            imports, calls = extract_names_from_tokens(tokenize.tokenize(source.readline))
+        analysis = FileAnalysis(imports, calls, self._get_stages(calls))
+        if key is not None:
+            self.analysis_cache.put(key, analysis.imports, analysis.calls, analysis.stages)
+        return analysis
+
+    def _get_counters(self):
+        """Returns the statistics counters of the prefilter, the cache, the tokenizer fallback and the notebook cells."""
+        cache = self.analysis_cache
+        return [self.stage_prefilter.checked, self.stage_prefilter.hits,
+                cache.hits if cache is not None else 0, cache.misses if cache is not None else 0, self.tokenized,
+                self.cells_analyzed, self.cells_reused, self.notebooks_reused,
+                cache.commit_hits if cache is not None else 0, cache.commit_misses if cache is not None else 0]
+
+    def _add_counters(self, deltas):
+        """Adds counter changes returned by a pool process."""
+        self.stage_prefilter.checked += deltas[0]
+        self.stage_prefilter.hits += deltas[1]
+        if self.analysis_cache is not None:
+            self.analysis_cache.hits += deltas[2]
+            self.analysis_cache.misses += deltas[3]
+        self.tokenized += deltas[4]
+        self.cells_analyzed += deltas[5]
+        self.cells_reused += deltas[6]
+        self.notebooks_reused += deltas[7]
+        if self.analysis_cache is not None:
+            self.analysis_cache.commit_hits += deltas[8]
+            self.analysis_cache.commit_misses += deltas[9]
+
+    def get_file_stages(self, filepath):
+        """Returns a tuple (stages, error) for a python source file or notebook. error is the name of the exception if the file could not be analyzed."""
+        try:
+            # Files that do not mention any function of the dictionary are not parsed
+            analysis = self.analyze_file(filepath, self.stage_prefilter)
+            if analysis is None:
+                return None, 'FileNotReadableError'
+            return analysis.stages, None
+        except Exception as e:
+            # Expect SyntaxError, FileNotFoundError, PermissionError, OSError and maybe more
+            return None, type(e).__name__
+
+    def analyze_stages(self, filepaths, n_processes=1):
+        """
+        Determines the ml stages of many python source files and notebooks. Requires an API dictionary.
+        Args:
+            filepaths:      List of paths of python source files and notebooks.
+            n_processes:    Number of processes to analyze the files with. None means all cores. Inside the workers of
+                            a regular (daemonic) pool, and for fewer than MIN_PARALLEL_FILES files, the files are
+                            analyzed sequentially.
+        Returns:    Generator of tuples (filepath, stages, error), in arbitrary order. stages is None if the file could
+                    not be analyzed, error is then the name of the exception.
+        """
+        n_processes = min(get_n_processes(n_processes), len(filepaths))
+        if n_processes <= 1 or len(filepaths) < MIN_PARALLEL_FILES:
+            for filepath in filepaths:
+                stages, error = self.get_file_stages(filepath)
+                yield filepath, stages, error
+            return
+
+        # Start with the largest files so that no large file is left over at the end
+        def size(filepath):
+            try:
+                return os.path.getsize(filepath)
+            except OSError:
+                return 0
+        filepaths = sorted(filepaths, key=size, reverse=True)
+        with multiprocessing.Pool(processes=n_processes, initializer=_init_worker, initargs=(self,)) as pool:
+            for filepath, stages, error, deltas, skipped in pool.imap_unordered(_analyze_stages_worker, filepaths):
+                # Merge the statistics and skip records of the analyzer copies in the workers
+                self._add_counters(deltas)
+                if self.budget is not None:
+                    self.budget.skipped += skipped
+                yield filepath, stages, error
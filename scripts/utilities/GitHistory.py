@@ -0,0 +1,451 @@
+import os
+import subprocess
+import time
+from collections import namedtuple
+from datetime import datetime
+from fnmatch import fnmatchcase
+
+"""
+Reads the history of a git repository with git plumbing commands instead of pydriller: one streaming
+'git log --raw -z' for the changed files of all commits and one long-lived 'git cat-file --batch' process for the
+contents of the files that are actually needed. No diffs are computed and no blobs of other files are loaded.
+Blobless partial clones (git clone --filter=blob:none) are supported: the needed blobs are fetched in batches.
+"""
+
+# SHA git uses for the missing side of an added or deleted file
+NULL_SHA = '0' * 40
+
+# A file changed by a commit. old_path/old_blob are None for added files, new_path/new_blob are None for deleted
+# files. status is the status letter of git diff (A, D, M, R, T, ...). added and removed are the numbers of changed
+# lines if git log was run with --numstat (0 for binary files), None otherwise.
+FileChange = namedtuple('FileChange', ['old_path', 'new_path', 'old_blob', 'new_blob', 'status', 'added', 'removed'],
+                        defaults=(None, None))
+
+# A commit with its parents, its author date (timezone-aware datetime), its author and the list of changed files.
+# Merge commits have no changed files, like in pydriller.
+GitCommit = namedtuple('GitCommit', ['hash', 'parents', 'author_date', 'author_name', 'author_email', 'changes'])
+
+# Header of each commit in the output of git log. Fields are separated by \x1f, the header ends with a NUL.
+_LOG_FORMAT = '--format=%x1e%H%x1f%P%x1f%aI%x1f%an%x1f%ae'
+# Arguments for the changed files of each commit, with renames detected like in pydriller's diffs
+_LOG_ARGS = ['--raw', '-z', '--no-abbrev', '-M', '--no-color', _LOG_FORMAT]
+# Number of commits whose missing blobs are fetched together in a partial clone
+PREFETCH_COMMITS = 1000
+# Files whose contents are read. In partial clones renames are only detected and lines only counted for these files,
+# since git would fetch the blob of every other added, deleted or modified file for that.
+SOURCE_PATHSPECS = ('*.py', '*.ipynb')
+# maintain repacks repositories with more packs or loose objects than this
+REPACK_MAX_PACKS = 8
+REPACK_MAX_LOOSE_OBJECTS = 10000
+
+# Steps run by GitHistory.maintain. Each flag is True if the step succeeded.
+MaintenanceResult = namedtuple('MaintenanceResult', ['repacked', 'commit_graph', 'multi_pack_index'])
+
+
+def _decode_path(path):
+    return path.decode('utf-8', errors='surrogateescape')
+
+
+class GitHistory:
+    """Streams the commits of a repository and reads blobs by their SHA. Use as a context manager or call close()."""
+
+    def __init__(self, local_dir, git='git', source_pathspecs=SOURCE_PATHSPECS):
+        """
+        Args:
+            local_dir:          Directory of the repository.
+            git:                Git executable.
+            source_pathspecs:   Glob patterns of the files whose contents are read (see SOURCE_PATHSPECS).
+        """
+        self.local_dir = local_dir
+        self.git = git
+        self.source_pathspecs = list(source_pathspecs)
+        # Whether the repository is a partial clone. None until it is checked.
+        self._partial = None
+        self._cat_file = None
+        # Blobs available locally, only tracked in partial clones. None until they are listed.
+        self._local_blobs = None
+        # Number of fetches and of blobs fetched from the promisor remote
+        self.fetches = 0
+        self.fetched_blobs = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _command(self, *args):
+        # Settings of the user must not change the output format
+        return [self.git, '-C', self.local_dir, '-c', 'log.showRoot=true', '-c', 'log.showSignature=false',
+                '-c', 'core.quotePath=false'] + list(args)
+
+    def iter_commits(self, revisions=('HEAD',), log_args=(), chunk_size=1 << 16):
+        """
+        Generator of GitCommit for all commits reachable from the revisions, oldest first (like pydriller).
+        Renames are detected like in pydriller's diffs (-M). In partial clones only between source files, and lines are
+        only counted for source files (see _complete_partial).
+        Args:
+            revisions:  Revisions to start from.
+            log_args:   Additional arguments for git log, e.g. ['--since=2020-01-01'], or ['--numstat'] to count the
+                        changed lines.
+            chunk_size: Number of bytes read from git log at once.
+        """
+        args = ['log', '--reverse'] + self._log_args(log_args) + list(revisions) + ['--']
+        yield from self._complete_partial(self._stream_log(args, None, chunk_size), log_args, chunk_size)
+
+    def iter_listed_commits(self, shas, log_args=(), chunk_size=1 << 16):
+        """
+        Generator of GitCommit for exactly the given commits, in the given order. Used to mine a contiguous range of
+        the list returned by rev_list.
+        Args:
+            shas:       List of commit SHAs.
+            log_args:   Additional arguments for git log that change the output, e.g. ['--diff-merges=first-parent'].
+            chunk_size: Number of bytes read from git log at once.
+        """
+        args = ['log', '--no-walk=unsorted', '--stdin'] + self._log_args(log_args) + ['--']
+        commits = self._stream_log(args, ''.join(sha + '\n' for sha in shas).encode('ascii'), chunk_size)
+        yield from self._complete_partial(commits, log_args, chunk_size)
+
+    def is_partial(self):
+        """Returns True if the repository is a partial clone with a promisor remote."""
+        if self._partial is None:
+            self._partial = self.promisor_remote() is not None
+        return self._partial
+
+    def _is_source(self, change):
+        path = change.new_path or change.old_path
+        return any(fnmatchcase(path, pattern) for pattern in self.source_pathspecs)
+
+    def _log_args(self, log_args):
+        """
+        Returns the arguments for the changed files of each commit. In partial clones the first git log neither detects
+        renames nor counts lines, both would make git fetch the blobs of all changed files one by one.
+        """
+        if not self.is_partial():
+            return _LOG_ARGS + list(log_args)
+        return ['--no-renames' if arg == '-M' else arg for arg in _LOG_ARGS] \
+            + [arg for arg in log_args if arg != '--numstat']
+
+    def _complete_partial(self, commits, log_args, chunk_size, batch_size=PREFETCH_COMMITS):
+        """
+        Generator passing on GitCommit tuples. In partial clones the changes of the source files are replaced in batches
+        of commits: their blobs are fetched with one request, then a second git log limited to the source files detects
+        renames and counts lines (with --numstat in log_args). Changes of other files keep no line counts.
+        """
+        if not self.is_partial():
+            yield from commits
+            return
+        batch = []
+        for commit in commits:
+            batch.append(commit)
+            if len(batch) >= batch_size:
+                yield from self._complete_batch(batch, log_args, chunk_size)
+                batch = []
+        yield from self._complete_batch(batch, log_args, chunk_size)
+
+    def _complete_batch(self, commits, log_args, chunk_size):
+        shas = [commit.hash for commit in commits if any(self._is_source(change) for change in commit.changes)]
+        if not shas:
+            yield from commits
+            return
+        self.prefetch_blobs([blob for commit in commits for change in commit.changes if self._is_source(change)
+                             for blob in (change.old_blob, change.new_blob) if blob is not None])
+        args = ['log', '--no-walk=unsorted', '--stdin'] + _LOG_ARGS + list(log_args) + ['--'] + self.source_pathspecs
+        source_changes = {commit.hash: commit.changes for commit in
+                          self._stream_log(args, ''.join(sha + '\n' for sha in shas).encode('ascii'), chunk_size)}
+        for commit in commits:
+            if commit.hash in source_changes:
+                other_changes = [change for change in commit.changes if not self._is_source(change)]
+                commit = commit._replace(changes=source_changes[commit.hash] + other_changes)
+            yield commit
+
+    def _stream_log(self, args, stdin_data, chunk_size):
+        """Runs git log with the given arguments and parses its output while it is produced."""
+        process = subprocess.Popen(self._command(*args), stdin=subprocess.PIPE if stdin_data is not None else None,
+                                   stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try:
+            if stdin_data is not None:
+                # git log reads all revisions from stdin before it writes anything
+                process.stdin.write(stdin_data)
+                process.stdin.close()
+            yield from self._parse_log(self._tokens(process.stdout, chunk_size))
+        finally:
+            process.stdout.close()
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+
+    @staticmethod
+    def _tokens(stream, chunk_size):
+        """Splits a stream at NUL bytes. Generator of the tokens (bytes)."""
+        rest = b''
+        for chunk in iter(lambda: stream.read(chunk_size), b''):
+            tokens = (rest + chunk).split(b'\0')
+            rest = tokens.pop()
+            yield from tokens
+        if rest:
+            yield rest
+
+    @staticmethod
+    def _parse_log(tokens):
+        """Parses the tokens of 'git log --raw -z [--numstat]' into GitCommit tuples."""
+        commit = None
+        # Index of the next change to add the numbers of --numstat to. They follow the raw entries in the same order.
+        n_counted = 0
+        tokens = iter(tokens)
+        for token in tokens:
+            token = token.lstrip(b'\n')
+            if token.startswith(b'\x1e'):
+                if commit is not None:
+                    yield commit
+                sha, parents, date, name, email = token[1:].decode('utf-8', errors='replace').split('\x1f')
+                commit = GitCommit(sha, parents.split(), datetime.fromisoformat(date), name, email, [])
+                n_counted = 0
+            elif token[:1].isdigit() or token.startswith(b'-\t'):
+                # <added> TAB <removed> TAB <path>, or an empty path followed by two paths for renames and copies
+                added, removed, path = token.split(b'\t', 2)
+                if not path:
+                    next(tokens)
+                    next(tokens)
+                if n_counted < len(commit.changes):
+                    # Binary files are counted as '-'
+                    commit.changes[n_counted] = commit.changes[n_counted]._replace(
+                        added=int(added) if added != b'-' else 0, removed=int(removed) if removed != b'-' else 0)
+                    n_counted += 1
+            elif token.startswith(b':'):
+                # :old_mode new_mode old_blob new_blob status, followed by one path (two for renames and copies)
+                old_mode, new_mode, old_blob, new_blob, status = token[1:].decode('ascii').split(' ')
+                path = _decode_path(next(tokens))
+                old_path = new_path = path
+                if status[0] in 'RC':
+                    new_path = _decode_path(next(tokens))
+                old_blob = None if old_blob == NULL_SHA else old_blob
+                new_blob = None if new_blob == NULL_SHA else new_blob
+                if old_blob is None:
+                    old_path = None
+                if new_blob is None:
+                    new_path = None
+                commit.changes.append(FileChange(old_path, new_path, old_blob, new_blob, status[0]))
+        if commit is not None:
+            yield commit
+
+    def _run(self, *args):
+        """Runs a git command. Returns its output (bytes), or None if it fails."""
+        result = subprocess.run(self._command(*args), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        return result.stdout if result.returncode == 0 else None
+
+    def rev_parse(self, revision):
+        """Returns the SHA of the commit a revision points to, or None if it does not exist (e.g. an empty repository)."""
+        output = self._run('rev-parse', '--verify', '--quiet', revision + '^{commit}')
+        return output.decode('ascii').strip() if output else None
+
+    def rev_list(self, revisions=('HEAD',), log_args=()):
+        """
+        Returns the SHAs of the commits reachable from the revisions, in the order of iter_commits (oldest first).
+        log_args limits the revision walk like in iter_commits, e.g. ['--first-parent'].
+        """
+        output = self._run('rev-list', '--reverse', *log_args, *revisions, '--') or b''
+        return output.decode('ascii').split()
+
+    def list_branches(self):
+        """
+        Returns (name, SHA) of all local branches and remote-tracking branches, e.g. ('main', ...) and
+        ('origin/feature', ...). Symbolic refs like origin/HEAD are left out.
+        """
+        output = self._run('for-each-ref', '--format=%(refname:short)%00%(objectname)%00%(symref)%00%(objecttype)',
+                           'refs/heads', 'refs/remotes') or b''
+        branches = []
+        for line in output.decode('utf-8', errors='replace').splitlines():
+            name, sha, symref, kind = line.split('\0')
+            if not symref and kind == 'commit':
+                branches.append((name, sha))
+        return branches
+
+    def branch_masks(self, tips):
+        """
+        Returns a bitmask for each commit reachable from the tips, bit i is set if the commit is reachable from tips[i].
+        The masks are propagated from children to parents in one pass over the commits in topological order, so the
+        cost grows with the number of commits and not with the number of tips.
+        """
+        masks = {}
+        for i, tip in enumerate(tips):
+            masks[tip] = masks.get(tip, 0) | (1 << i)
+        output = self._run('rev-list', '--topo-order', '--parents', *set(tips), '--') or b''
+        for line in output.decode('ascii').splitlines():
+            sha, *parents = line.split(' ')
+            # All children of a commit are listed before it, so its mask is complete
+            mask = masks.get(sha, 0)
+            for parent in parents:
+                masks[parent] = masks.get(parent, 0) | mask
+        return masks
+
+    def commit_times(self, revisions=('HEAD',), log_args=()):
+        """Returns (SHA, author date as UNIX timestamp) of the commits of rev_list, oldest first."""
+        output = self._run('log', '--reverse', '--format=%H %at', *log_args, *revisions, '--') or b''
+        commits = []
+        for line in output.decode('ascii').splitlines():
+            sha, timestamp = line.split(' ')
+            commits.append((sha, int(timestamp)))
+        return commits
+
+    def is_ancestor(self, ancestor, revision):
+        """Returns True if the commit ancestor is reachable from revision. Missing commits are no ancestors."""
+        return self._run('merge-base', '--is-ancestor', ancestor, revision) is not None
+
+    def iter_files(self, revision):
+        """Generator of (path, blob SHA) for all files in the tree of a commit. Submodules are left out."""
+        output = self._run('ls-tree', '-r', '-z', '--full-tree', revision) or b''
+        for entry in output.split(b'\0'):
+            if not entry:
+                continue
+            # <mode> SP <type> SP <object> TAB <path>
+            info, path = entry.split(b'\t', 1)
+            mode, kind, sha = info.decode('ascii').split(' ')
+            if kind == 'blob':
+                yield _decode_path(path), sha
+
+    def count_objects(self):
+        """Returns the statistics of git count-objects -v as a dictionary, e.g. {'count': loose objects, 'packs': ...}."""
+        output = self._run('count-objects', '-v') or b''
+        counts = {}
+        for line in output.decode('ascii', errors='replace').splitlines():
+            key, _, value = line.partition(':')
+            if value.strip().isdigit():
+                counts[key.strip()] = int(value)
+        return counts
+
+    def time_traversal(self, revisions=('--all',)):
+        """
+        Returns the seconds a plain revision walk over all commits takes (git rev-list), the part of every history
+        traversal that the commit-graph speeds up. Returns None if the walk fails.
+        """
+        start = time.perf_counter()
+        if self._run('rev-list', *revisions) is None:
+            return None
+        return time.perf_counter() - start
+
+    def has_commit_graph(self):
+        """Returns True if the repository has a commit-graph, as a single file or as a chain of split files."""
+        for path in ('objects/info/commit-graph', 'objects/info/commit-graphs/commit-graph-chain'):
+            output = self._run('rev-parse', '--git-path', path)
+            if output and os.path.exists(os.path.join(self.local_dir, output.decode('utf-8').strip())):
+                return True
+        return False
+
+    def maintain(self, repack=None):
+        """
+        Prepares the repository for revision walks. Fresh clones only have one pack and no commit-graph, so every walk
+        parses each commit object. Writes a commit-graph and a multi-pack-index. The commit-graph has no changed-path
+        Bloom filters: they cost a tree diff per commit and only speed up path-limited walks, which are not used.
+        Args:
+            repack: Whether all objects are packed into one pack first (git repack -a -d). None repacks only if the
+                    repository has more than REPACK_MAX_PACKS packs or REPACK_MAX_LOOSE_OBJECTS loose objects.
+        Returns:    MaintenanceResult
+        """
+        if repack is None:
+            counts = self.count_objects()
+            repack = counts.get('packs', 0) > REPACK_MAX_PACKS or counts.get('count', 0) > REPACK_MAX_LOOSE_OBJECTS
+        # Objects of promisor packs in partial clones are kept in a separate pack by git repack
+        repacked = repack and self._run('repack', '-a', '-d', '-q') is not None
+        commit_graph = self._run('commit-graph', 'write', '--reachable', '--no-progress') is not None
+        multi_pack_index = self._run('multi-pack-index', 'write', '--no-progress') is not None
+        return MaintenanceResult(repacked, commit_graph, multi_pack_index)
+
+    def promisor_remote(self):
+        """Returns the name of the remote missing objects of a partial clone are fetched from, or None for complete clones."""
+        output = self._run('config', '--get-regexp', r'^remote\..*\.promisor$') or b''
+        for line in output.decode('utf-8', errors='replace').splitlines():
+            key, _, value = line.partition(' ')
+            if value.strip().lower() == 'true':
+                return key[len('remote.'):-len('.promisor')]
+        return None
+
+    def _list_local_blobs(self):
+        """Returns the set of the SHAs of all blobs in the local object database. Missing blobs are not fetched."""
+        output = self._run('cat-file', '--batch-all-objects', '--batch-check=%(objectname) %(objecttype)') or b''
+        return {line[:-5].decode('ascii') for line in output.splitlines() if line.endswith(b' blob')}
+
+    def prefetch_blobs(self, shas, remote=None):
+        """
+        Fetches the blobs that are missing in a partial clone with one request, like git does for missing objects
+        itself. Without the prefetch, git cat-file would fetch each missing blob on its own.
+        Args:
+            shas:   SHAs of the blobs that will be read.
+            remote: Promisor remote. Looked up if omitted.
+        Returns:    Number of blobs requested.
+        """
+        if self._local_blobs is None:
+            self._local_blobs = self._list_local_blobs()
+        missing = sorted(set(shas) - self._local_blobs)
+        if not missing:
+            return 0
+        remote = remote or self.promisor_remote()
+        if remote is None:
+            return 0
+        # Same options as the fetches git starts for missing objects of partial clones
+        args = ['-c', 'fetch.negotiationAlgorithm=noop', 'fetch', remote, '--no-tags', '--no-write-fetch-head',
+                '--recurse-submodules=no', '--filter=blob:none', '--stdin']
+        subprocess.run(self._command(*args), input=''.join(sha + '\n' for sha in missing).encode('ascii'),
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        # Blobs that still cannot be fetched are not requested again, cat-file reports them as missing
+        self._local_blobs.update(missing)
+        self.fetches += 1
+        self.fetched_blobs += len(missing)
+        return len(missing)
+
+    def prefetching(self, commits, wanted, batch_size=PREFETCH_COMMITS):
+        """
+        Generator passing on GitCommit tuples. In a partial clone the blobs of the changes selected by wanted are
+        fetched in batches of commits before the commits are passed on. Complete clones pass the commits unchanged.
+        Args:
+            commits:    Iterable of GitCommit, e.g. from iter_commits.
+            wanted:     Function (FileChange) -> bool selecting the changes whose blobs will be read.
+            batch_size: Number of commits per fetch.
+        """
+        remote = self.promisor_remote()
+        if remote is None:
+            yield from commits
+            return
+        batch = []
+        for commit in commits:
+            batch.append(commit)
+            if len(batch) >= batch_size:
+                self._prefetch_batch(batch, wanted, remote)
+                yield from batch
+                batch = []
+        self._prefetch_batch(batch, wanted, remote)
+        yield from batch
+
+    def _prefetch_batch(self, commits, wanted, remote):
+        shas = [blob for commit in commits for change in commit.changes if wanted(change)
+                for blob in (change.old_blob, change.new_blob) if blob is not None]
+        self.prefetch_blobs(shas, remote)
+
+    def read_blob(self, sha):
+        """Returns the content of a blob as bytes, or None if the object does not exist."""
+        if self._cat_file is None:
+            self._cat_file = subprocess.Popen(self._command('cat-file', '--batch'), stdin=subprocess.PIPE,
+                                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        process = self._cat_file
+        process.stdin.write(sha.encode('ascii') + b'\n')
+        process.stdin.flush()
+        header = process.stdout.readline().split()
+        if len(header) != 3:
+            # <sha> missing
+            return None
+        size = int(header[2])
+        data = process.stdout.read(size)
+        # Each object is followed by a newline
+        process.stdout.read(1)
+        return data
+
+    def close(self):
+        """Stops the cat-file process."""
+        if self._cat_file is not None:
+            try:
+                self._cat_file.stdin.close()
+            except OSError:
+                pass
+            self._cat_file.wait()
+            self._cat_file.stdout.close()
+            self._cat_file = None
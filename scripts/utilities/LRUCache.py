@@ -0,0 +1,42 @@
+from collections import OrderedDict
+
+"""
+Dictionary with a bounded number of entries for the memos of the mining (stage bitmasks of blobs, analyses of notebook
+cells). Histories of large repositories have millions of blobs, so unbounded memos would grow with the history.
+"""
+
+
+class LRUCache(OrderedDict):
+    """
+    Dictionary evicting the least recently used entries once it holds more than maxsize entries. Lookups with get and
+    in count as uses, [] does not, so that the cache can be iterated and copied like a dictionary.
+    """
+
+    def __init__(self, maxsize=None, items=()):
+        """
+        Args:
+            maxsize:    Maximum number of entries, None for no limit.
+            items:      Initial entries (dictionary or iterable of pairs).
+        """
+        super().__init__()
+        self.maxsize = maxsize
+        self.update(items)
+
+    def __contains__(self, key):
+        if super().__contains__(key):
+            self.move_to_end(key)
+            return True
+        return False
+
+    def get(self, key, default=None):
+        if super().__contains__(key):
+            self.move_to_end(key)
+            return self[key]
+        return default
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if self.maxsize is not None:
+            while len(self) > self.maxsize:
+                self.popitem(last=False)
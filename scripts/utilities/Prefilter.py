@@ -0,0 +1,97 @@
+import re
+
+"""
+Lexical prefilter deciding whether a source file can contain any name of interest before it is parsed.
+"""
+
+# A name starts at a word boundary or right after an escaped newline/tab inside the JSON of a notebook
+_LEFT_BOUNDARY = r'(?:\b|(?<=\\[nrt]))'
+
+
+def _trie_pattern(names):
+    """Returns a regular expression matching any of the names. The alternatives are nested as a trie so that the regex engine never compares a position against more than one branch per character."""
+    trie = {}
+    for name in names:
+        node = trie
+        for char in name:
+            node = node.setdefault(char, {})
+        # Empty key marks the end of a name
+        node[''] = {}
+
+    def build(node):
+        is_end = '' in node
+        branches = [re.escape(char) + build(child)
+                    for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:{})'.format('|'.join(branches))
+        return '(?:{})?'.format(body) if is_end else body
+
+    return build(trie)
+
+
+class LexicalPrefilter:
+    """
+    Scans raw sources for candidate names with a single compiled automaton. Sources without any candidate cannot
+    produce a result and do not have to be parsed. Keeps track of how many sources were checked and how many could be skipped.
+    """
+
+    def __init__(self, names, prefix=False):
+        """
+        Args:
+            names:      Iterable of names to search for, e.g. the functions of the API dictionary.
+            prefix:     If True, names also match as the prefix of a longer identifier (e.g. 'tensorflow' matches
+                        'tensorflow_hub'). Used for import prefixes.
+        """
+        self.names = frozenset(names)
+        pattern = _LEFT_BOUNDARY + _trie_pattern(self.names)
+        if not prefix:
+            pattern += r'\b'
+        if not self.names:
+            # Never matches
+            pattern = r'(?!)'
+        self._str_regex = re.compile(pattern, re.ASCII)
+        self._bytes_regex = re.compile(pattern.encode('ascii'))
+        # Consecutive chunks of a file overlap by this many bytes so that no name is cut in half
+        self._overlap = max((len(name) for name in self.names), default=0) + 2
+        self.checked = 0
+        self.hits = 0
+
+    def matches(self, source):
+        """Returns True if the source (str, bytes or mmap) contains at least one candidate name."""
+        regex = self._str_regex if isinstance(source, str) else self._bytes_regex
+        found = regex.search(source) is not None
+        self.checked += 1
+        if not found:
+            return False
+        self.hits += 1
+        return True
+
+    def matches_file(self, filepath, chunk_size=1 << 20):
+        """Returns True if the file contains at least one candidate name. Reads the file in chunks, so memory use does not depend on its size."""
+        found = False
+        with open(filepath, 'rb') as f:
+            tail = b''
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                if self._bytes_regex.search(tail + chunk) is not None:
+                    found = True
+                    break
+                tail = chunk[-self._overlap:]
+        self.checked += 1
+        if found:
+            self.hits += 1
+        return found
+
+    @property
+    def misses(self):
+        """Number of sources that did not contain a candidate and were skipped."""
+        return self.checked - self.hits
+
+    def hit_ratio(self):
+        """Returns the share of checked sources that contained a candidate name."""
+        return self.hits / self.checked if self.checked else 0.0
+
+    def report(self):
+        """Returns a short summary of the hit/miss ratio."""
+        return "Prefilter: {} of {} sources contained candidate names ({:.1%}), skipped parsing {}".format(
+            self.hits, self.checked, self.hit_ratio(), self.misses)
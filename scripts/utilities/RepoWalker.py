@@ -0,0 +1,234 @@
+import os
+import re
+from collections import Counter
+
+"""
+Walks the files of a repository like os.walk, but prunes directories that never contain code of the project itself
+(version control data, committed virtual environments, installed packages, notebook checkpoints, vendored examples) and
+everything excluded by .gitignore files. Counts how many directories and files each rule pruned.
+"""
+
+
+def _is_virtualenv(path):
+    """Returns True if the directory is the root of a virtual environment."""
+    return os.path.exists(os.path.join(path, 'pyvenv.cfg')) \
+        or os.path.exists(os.path.join(path, 'bin', 'activate')) \
+        or os.path.exists(os.path.join(path, 'Scripts', 'activate'))
+
+
+# Pruning rules for directories. Each rule maps its name to a function (name, path, parent name) -> bool.
+PRUNE_RULES = {
+    'vcs': lambda name, path, parent: name in ('.git', '.hg', '.svn'),
+    'site-packages': lambda name, path, parent: name in ('site-packages', 'dist-packages'),
+    'node_modules': lambda name, path, parent: name == 'node_modules',
+    'checkpoints': lambda name, path, parent: name == '.ipynb_checkpoints',
+    'pycache': lambda name, path, parent: name == '__pycache__',
+    # Copies of the examples of the tensorflow repository, e.g. third_party/tensorflow/examples
+    'tensorflow-examples': lambda name, path, parent: name == 'examples' and parent == 'tensorflow',
+    'virtualenv': lambda name, path, parent: _is_virtualenv(path),
+}
+
+
+def _translate(pattern):
+    """Translates a gitignore glob pattern (without leading or trailing slash) into a regular expression."""
+    regex = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        char = pattern[i]
+        if char == '*':
+            if pattern.startswith('**/', i):
+                # Zero or more directories
+                regex.append('(?:.*/)?')
+                i += 3
+                continue
+            if pattern.startswith('**', i):
+                regex.append('.*')
+                i += 2
+                continue
+            regex.append('[^/]*')
+        elif char == '?':
+            regex.append('[^/]')
+        elif char == '[':
+            end = pattern.find(']', i + 2)
+            if end == -1:
+                regex.append(re.escape(char))
+            else:
+                chars = pattern[i + 1:end].replace('\\', '\\\\')
+                if chars.startswith('!'):
+                    chars = '^' + chars[1:]
+                regex.append('[{}]'.format(chars))
+                i = end + 1
+                continue
+        elif char == '\\' and i + 1 < n:
+            regex.append(re.escape(pattern[i + 1]))
+            i += 2
+            continue
+        else:
+            regex.append(re.escape(char))
+        i += 1
+    return re.compile(''.join(regex), re.DOTALL)
+
+
+class GitIgnore:
+    """Patterns of one .gitignore file. Supports negation, anchored patterns, directory-only patterns and '**'."""
+
+    def __init__(self, lines):
+        """
+        Args:
+            lines:  Lines of the .gitignore file.
+        """
+        # Tuples (regex, negate, directory only, anchored)
+        self.rules = []
+        for line in lines:
+            line = line.rstrip('\n').rstrip('\r')
+            # Trailing spaces are ignored unless escaped
+            if not line.endswith('\\ '):
+                line = line.rstrip(' ')
+            if not line or line.startswith('#'):
+                continue
+            negate = line.startswith('!')
+            if negate:
+                line = line[1:]
+            elif line.startswith('\\!') or line.startswith('\\#'):
+                line = line[1:]
+            directory_only = line.endswith('/')
+            line = line.rstrip('/')
+            if not line:
+                continue
+            # Patterns with a slash at the beginning or in the middle are relative to the .gitignore file
+            anchored = '/' in line
+            line = line.lstrip('/')
+            self.rules.append((_translate(line), negate, directory_only, anchored))
+
+    @classmethod
+    def from_file(cls, filepath):
+        """Reads a .gitignore file. Returns None if it cannot be read or contains no patterns."""
+        try:
+            with open(filepath, encoding='utf-8', errors='replace') as f:
+                gitignore = cls(f.readlines())
+        except OSError:
+            return None
+        return gitignore if gitignore.rules else None
+
+    def match(self, relpath, is_dir):
+        """
+        Returns True if the path is ignored, False if it is re-included by a negated pattern and None if no pattern
+        matches.
+        Args:
+            relpath:    Path relative to the directory of the .gitignore file, separated by '/'.
+            is_dir:     Whether the path is a directory.
+        """
+        name = relpath.rsplit('/', 1)[-1]
+        # The last matching pattern decides
+        for regex, negate, directory_only, anchored in reversed(self.rules):
+            if directory_only and not is_dir:
+                continue
+            if regex.fullmatch(relpath if anchored else name):
+                return not negate
+        return None
+
+
+class RepoWalker:
+    """Walks a repository with os.scandir and prunes directories and files by rules. Collects per-rule statistics."""
+
+    def __init__(self, root, rules=tuple(PRUNE_RULES), gitignore=True):
+        """
+        Args:
+            root:       Directory of the repository.
+            rules:      Names of the PRUNE_RULES to apply. Pass an empty tuple to visit every directory.
+            gitignore:  If True, files and directories excluded by .gitignore files (and .git/info/exclude) are pruned.
+        """
+        self.root = root
+        self.rules = [(name, PRUNE_RULES[name]) for name in rules]
+        self.gitignore = gitignore
+        # Number of pruned directories (or ignored files) per rule, and the number of visited directories and files
+        self.stats = Counter()
+
+    def _is_ignored(self, ignores, relpath, is_dir):
+        """Returns True if one of the .gitignore files excludes the path. Deeper .gitignore files take precedence."""
+        for base, gitignore in reversed(ignores):
+            result = gitignore.match(relpath[len(base) + 1:] if base else relpath, is_dir)
+            if result is not None:
+                return result
+        return False
+
+    def _prune_rule(self, name, path, parent):
+        """Returns the name of the first rule pruning the directory, or None."""
+        for rule, applies in self.rules:
+            if applies(name, path, parent):
+                return rule
+        return None
+
+    def walk(self):
+        """
+        Generator of tuples (dirpath, dirnames, filenames) like os.walk(root) in top-down order. Pruned directories and
+        ignored files are left out. Like with os.walk, removing names from dirnames prevents visiting them. Directories
+        that cannot be read are skipped and symbolic links to directories are not followed.
+        """
+        ignores = []
+        if self.gitignore:
+            exclude = GitIgnore.from_file(os.path.join(self.root, '.git', 'info', 'exclude'))
+            if exclude is not None:
+                ignores.append(('', exclude))
+        # Stack of (directory, path relative to the root, .gitignore files of the ancestors)
+        stack = [(self.root, '', ignores)]
+        while stack:
+            dirpath, relpath, ignores = stack.pop()
+            try:
+                with os.scandir(dirpath) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+            self.stats['directories'] += 1
+
+            if self.gitignore and any(entry.name == '.gitignore' for entry in entries):
+                gitignore = GitIgnore.from_file(os.path.join(dirpath, '.gitignore'))
+                if gitignore is not None:
+                    ignores = ignores + [(relpath, gitignore)]
+
+            parent = os.path.basename(dirpath)
+            dirnames = []
+            filenames = []
+            links = set()
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                entry_relpath = relpath + '/' + entry.name if relpath else entry.name
+                if self.gitignore and ignores and self._is_ignored(ignores, entry_relpath, is_dir):
+                    self.stats['gitignore'] += 1
+                    continue
+                if is_dir:
+                    rule = self._prune_rule(entry.name, entry.path, parent)
+                    if rule is not None:
+                        self.stats[rule] += 1
+                        continue
+                    dirnames.append(entry.name)
+                    if entry.is_symlink():
+                        links.add(entry.name)
+                else:
+                    filenames.append(entry.name)
+            self.stats['files'] += len(filenames)
+
+            yield dirpath, dirnames, filenames
+
+            # Visit the remaining subdirectories in order
+            for name in reversed(dirnames):
+                if name not in links:
+                    stack.append((os.path.join(dirpath, name), relpath + '/' + name if relpath else name, ignores))
+
+    def files(self, extensions=None):
+        """Generator of the paths of all files that are not pruned. extensions optionally restricts them, e.g. ('.py', '.ipynb')."""
+        for dirpath, dirnames, filenames in self.walk():
+            for f in filenames:
+                if extensions is None or f.endswith(extensions):
+                    yield os.path.join(dirpath, f)
+
+    def report(self):
+        """Returns a short summary of the pruned directories and files."""
+        pruned = ', '.join('{}: {}'.format(rule, n) for rule, n in sorted(self.stats.items())
+                           if rule not in ('directories', 'files'))
+        return "Walker: visited {} directories with {} files, pruned {}".format(
+            self.stats['directories'], self.stats['files'], pruned or 'nothing')
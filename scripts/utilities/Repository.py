@@ -1,7 +1,7 @@
 from distutils.log import error
+import csv
 import json
 from threading import local
-import numpy as np
 import git
 import ast
 import os
@@ -11,35 +11,145 @@ import shutil
 import platform
 from treelib import Node, Tree
 import pydriller
-import nbformat as nbf
-from nbconvert.exporters import PythonExporter
-from nbconvert.preprocessors import TagRemovePreprocessor
 import paramiko
 import tarfile
 import pysftp
+import multiprocessing
+import random
+from datetime import datetime
+from functools import partial
 from stat import S_ISDIR, S_ISREG
 
+from scripts.utilities.FileAnalyzer import FileAnalyzer
+from scripts.utilities.Prefilter import LexicalPrefilter
+from scripts.utilities.AnalysisCache import AnalysisCache, dictionary_fingerprint
+from scripts.utilities.AnalysisBudget import AnalysisBudget, BudgetExceededError, MAX_FILE_BYTES, MAX_PARSE_SECONDS
+from scripts.utilities.GitHistory import GitHistory
+from scripts.utilities.LRUCache import LRUCache
+from scripts.utilities.Watermark import Watermark
+from scripts.utilities.RepoWalker import RepoWalker, PRUNE_RULES
+from scripts.utilities.StageMap import StageMap
+from scripts.utilities.parallel import get_n_processes
+from scripts.utilities.commit_metrics import ChangedFile, CommitRecord, get_metrics, compute_metrics
+from scripts.utilities.sampling import SampledStages, required_sample_size, stratify, draw_sample, estimate_proportions
+
+# Histories with fewer commits per process are mined sequentially by get_commit_stages
+MIN_SHARD_COMMITS = 1000
+# Longer ranges are split further, so that a worker never holds more rows than this
+MAX_SHARD_COMMITS = 10000
+# Number of stage bitmasks of blobs kept in the memo of get_commit_stages. Older entries are evicted
+MAX_MASKS = 200000
+
 
 class FileNotReadableError(Exception):
     """Raised when a file could not be processed for analysis. Used only within the context of the Repository class."""
     pass
 
 
+# Repository of the process when mining a range of commits in a pool
+_shard_repository = None
+
+
+def _init_shard_worker(local_dir, analyzer):
+    global _shard_repository
+    repository = Repository(local_dir=local_dir)
+    # Share the analyzer, its cache and its budget (including the start time of the repository) with the parent
+    repository._analyzer = analyzer
+    repository.stage_prefilter = analyzer.stage_prefilter
+    repository.analysis_cache = analyzer.analysis_cache
+    repository.budget = analyzer.budget
+    repository.skipped = analyzer.budget.skipped
+    _shard_repository = repository
+
+
+def _drain(generator):
+    """Returns the items of a generator as a list, and the value the generator returned."""
+    items = []
+    while True:
+        try:
+            items.append(next(generator))
+        except StopIteration as stop:
+            return items, stop.value
+
+
+def _mine_shard_worker(shard):
+    """
+    Mines one range of commits in a pool process. Also returns the stage bitmasks of the blobs analyzed for the range,
+    the changes of the counters, the new skip records and the changes for the StageLineage (if tracked) so they can be
+    merged. The memo starts empty, so the memo of the parent is not copied for every range.
+    """
+    shas, log_args, stages, variant, metric_names, track_lineage, branches = shard
+    repository = _shard_repository
+    analyzer = repository._analyzer
+    counters = analyzer._get_counters()
+    n_skipped = len(repository.budget.skipped)
+    masks = LRUCache(MAX_MASKS)
+    metrics = get_metrics(metric_names)
+    lookup, store = repository._commit_cache_functions(stages, variant, metrics, track_lineage)
+    lineage_changes = [] if track_lineage else None
+    observe = (lambda *changes: lineage_changes.append(changes)) if track_lineage else None
+    with GitHistory(repository.local_dir) as history:
+        commits = repository._iter_git_commits(history, shas=shas, log_args=log_args, lookup=lookup)
+        try:
+            rows, completed = _drain(
+                repository._mine_commits(commits, analyzer.classifier, stages, masks, store, metrics, observe,
+                                         branches))
+        finally:
+            commits.close()
+    deltas = [new - old for new, old in zip(analyzer._get_counters(), counters)]
+    return rows, completed, masks, deltas, repository.budget.skipped[n_skipped:], lineage_changes
+
+
 class Repository:
     """Contains functions to perform analysis on a repository"""
 
-    def __init__(self, remote_url='', local_dir='', sftp_compressed='',sftp_uncompressed=''):
+    def __init__(self, remote_url='', local_dir='', sftp_compressed='',sftp_uncompressed='', analysis_cache=None,
+                 max_file_bytes=MAX_FILE_BYTES, max_parse_seconds=MAX_PARSE_SECONDS, max_repo_seconds=None,
+                 prune_rules=tuple(PRUNE_RULES), gitignore=True, clone_filter=None, checkout=True):
         """
         Args:
             remote_url:         Remote address to clone the repository from.
             local_dir:          Local directory where the repository is stored.
             sftp_compressed:    Url of a tar-compressed file containing the repository on an sftp server
             sftp_uncompressed:  Url of a folder containing the repository on an aftp server
+            analysis_cache:     Optional AnalysisCache or path of its database. Analysis results of files are looked up
+                                there by content and shared across repositories and runs.
+            max_file_bytes:     Larger files are skipped. Files with a null byte in their first 8 KB are skipped as binary.
+            max_parse_seconds:  Parses taking longer are aborted and the file is analyzed with the tokenizer instead.
+            max_repo_seconds:   Wall time budget for each analysis of the whole repository. None means no limit.
+            Files and commits cut by the budgets are listed in self.skipped.
+            prune_rules:        Names of the RepoWalker.PRUNE_RULES applied when walking the files of the repository.
+            gitignore:          Whether files excluded by .gitignore files are skipped when walking the repository.
+            clone_filter:       Object filter for cloning remote_url, e.g. 'blob:none' for a blobless partial clone. Only
+                                the commits and trees are downloaded, get_commit_stages fetches the blobs of the source
+                                files it reads in batches. The remote has to support filters (uploadpack.allowFilter).
+            checkout:           If False, remote_url is cloned without a working tree (git clone --no-checkout). Enough
+                                for get_commit_stages, which only reads the history.
 
             If only remote_url is provided, the repository is cloned into a temporary local folder and deleted upon destruction of the object. If only local_dir is procided, the repository is constructed based on the local copy that is already downloaded. If both are provided, the repository is cloned to the specified folder and kept after destruction of the object.
             Alternatively, only sftp_compressed can be provided in order to download the repo from an sftp server and temporarily store the extracted version locally.
         """
 
+        # Analyzer for single files. Created on first use and reused for all files.
+        self._analyzer = None
+        # Prefilters that skip parsing files without candidate names. Their counters report how much was skipped.
+        self.stage_prefilter = None
+        self.import_prefilter = LexicalPrefilter(['import'])
+        if isinstance(analysis_cache, str):
+            analysis_cache = AnalysisCache(analysis_cache)
+        self.analysis_cache = analysis_cache
+        self.budget = AnalysisBudget(max_file_bytes, max_parse_seconds, max_repo_seconds)
+        # Skip records: dictionaries with the keys 'path', 'reason', 'size' and 'elapsed'
+        self.skipped = self.budget.skipped
+        self.prune_rules = prune_rules
+        self.gitignore = gitignore
+        # Walker of the last walk through the files. Its statistics show what was pruned.
+        self.walker = None
+        # Number of files inspected by the last uses_library or has_stages query
+        self.files_inspected = 0
+        self.clone_filter = clone_filter
+        self.checkout = checkout
+
         if remote_url and local_dir:
             # Clone the repository and save it permanently in the specified local folder
             self.delete_when_done = False
@@ -105,9 +215,14 @@ class Repository:
         #         raise ValueError(
         #             "An error occured when trying to clone the repository. Skipping repo.")
 
+        options = ''
+        if self.clone_filter:
+            options += '--filter={} '.format(self.clone_filter)
+        if not self.checkout:
+            options += '--no-checkout '
         if platform.system() == 'Linux':
             # Clone the repository using terminal command
-            command = "git clone {} {}".format(remote_url, self.local_dir)
+            command = "git clone {}{} {}".format(options, remote_url, self.local_dir)
             proc = subprocess.Popen(
                 [command], stdout=subprocess.PIPE, shell=True)
             # In case that the repository requires authentication, an authentication prompt is opened in the terminal. Without user input this should trigger a timeout and the repository is skipped.
@@ -121,7 +236,7 @@ class Repository:
             # Clone the repository using gitpython
             try:
                 self.test_repo = git.Repo.clone_from(
-                    remote_url, self.local_dir)
+                    remote_url, self.local_dir, multi_options=options.split())
             except (git.exc.GitCommandError, UnicodeDecodeError):
                 # Handling error while cloning the repository
                 raise ValueError(
@@ -209,281 +324,861 @@ class Repository:
         sftp.close()
         transport.close()
 
-    def get_imports(self, filepath):
-        """Returns a list of libraries imported by the given file."""
-
-        imports = []
-        with open(filepath, 'r', encoding='utf-8') as source:
-            try:
-                # Create an abstract syntax tree
-                tree = ast.parse(source.read())
-                # Traverse the tree in search of import statements
-                for node in ast.walk(tree):
-                    # Check for Import
-                    if isinstance(node, ast.Import):
-                        names = node.names
-                        for name in names:
-                            imports.append(name.name)
-                    # Check for ImportFrom
-                    elif isinstance(node, ast.ImportFrom):
-                        if node.module is None:
-                            continue
-                        # Append the module from which is imported
-                        imports.append(node.module)
-            except SyntaxError as e:
-                # Handling files with syntax errors
-                raise e
+    def get_imports(self, filepath, prefilter=None):
+        """
+        Returns a list of libraries imported by the given file. Raises FileNotReadableError for unreadable notebooks.
+        Args:
+            filepath:   Path of the python source file or notebook.
+            prefilter:  LexicalPrefilter for the import names of interest. Files without a candidate are not parsed
+                        and return an empty list. Defaults to self.import_prefilter.
+        """
 
-        return imports
+        if prefilter is None:
+            prefilter = self.import_prefilter
+        # Parse the file once. Imports, calls and stages are cached together.
+        analysis = self._get_analyzer().analyze_file(filepath, prefilter)
+        if analysis is None:
+            raise FileNotReadableError("Error reading Jupyter notebook.")
+        return analysis.imports
 
-    def get_all_imports(self):
-        """ Returns a list with all imports for this repository."""
+    def get_all_imports(self, prefixes=None):
+        """
+        Returns a list with all imports for this repository.
+        Args:
+            prefixes:   Optional list of import prefixes, e.g. ['tensorflow']. If provided, only imports starting with
+                        one of the prefixes are returned and files that do not mention any prefix are not parsed.
+        """
 
+        # Files without an import statement (or without any of the prefixes) are not parsed
+        if prefixes is not None:
+            prefilter = LexicalPrefilter(prefixes, prefix=True)
+        else:
+            prefilter = LexicalPrefilter(['import'])
+        self.import_prefilter = prefilter
         imports = []
         # Keep track of how many files were skipped
         total_files = 0
         skipped_files = 0
+        self.budget.start_repository()
 
         # Iterate through the files in the repository
-        for root, directories, files in os.walk(self.local_dir):
+        for root, directories, files in self._walk():
+            if self.budget.repo_time_exceeded():
+                # The remaining files are not listed, the record names the repository
+                self.budget.skip(self.local_dir, 'repo_timeout', elapsed=self.budget.repo_elapsed())
+                print("Time budget of the repository exceeded. Skipping remaining files")
+                break
             for f in files:
-                filepath = ""
-                # Search Python source files for imports
-                if (f.endswith('.py')):
+                # Search Python source files and notebooks for imports
+                if (f.endswith('.py') or f.endswith('.ipynb')):
                     total_files += 1
                     filepath = os.path.join(root, f)
-                elif (f.endswith('.ipynb')):
-                    total_files += 1
                     try:
-                        filepath = self._convert_notebook(
-                            os.path.join(root, f))
-                    except FileNotReadableError:
+                        imports += self.get_imports(filepath, prefilter)
+                    except FileNotReadableError as e:
+                        print(e)
                         skipped_files += 1
-
-                # For .py files and successfully converted notebooks
-                if filepath and os.path.exists(filepath):
-                    try:
-                        imports += self.get_imports(filepath)
-                    except (SyntaxError, FileNotFoundError) as e:
+                    except (SyntaxError, UnicodeDecodeError, FileNotFoundError) as e:
                         print("Syntax error. Skipping file")
                         skipped_files += 1
+                    except BudgetExceededError as e:
+                        print(f"File exceeds budget ({e.reason}). Skipping file")
+                        skipped_files += 1
 
         # Removing duplicates
         imports = list(dict.fromkeys(imports))
+        if prefixes is not None:
+            imports = [i for i in imports if i.startswith(tuple(prefixes))]
         print("Skipped {} out of {} files".format(skipped_files, total_files))
+        print(self.walker.report())
+        print(prefilter.report())
+        print(self.budget.report())
 
         return imports
 
-    def _visit_node(self, node):
-        if type(node) == ast.Call:
-            return self._visit_node(node.func)
-        elif type(node) == ast.Attribute:
-            return node.attr
-        if type(node) == ast.Name:
-            return node.id
-
-    def _convert_notebook(self, filepath: str):
-        """Converts the notebook to a .py file and returns the filepath to the converted notebook.
-        Note: Make sure that nbconvert is installed! Otherwise no error will be raised, all notebook files are just skipped."""
-
-        # Convert to .py
-        os.system(
-            f'jupyter nbconvert \"{filepath}\" --to python')
-        converted_file_path = filepath[:-5]+'py'
-        # Remove notebook file to save time in future analysis
-        try:
-            os.remove(filepath)
-        except PermissionError:
-            pass
-        # If conversion was successfull, return the path to the new file
-        if os.path.exists(converted_file_path):
-            return converted_file_path
-        else:
-            raise FileNotReadableError("Error converting Jupyter notebook.")
-
-    def _process_ast(self, tree, functions_to_stages):
-        """Returns a list of ml stages for an abstract syntax tree"""
-        implemented_stages = []
-        # Iterate over the ast and check for all function calls if they are part of a stage of ml workflow
-        for node in ast.walk(tree):
-            if type(node) == ast.Call:
-                function_name = self._visit_node(node)
-                if function_name:
-                    try:
-                        stage = functions_to_stages[function_name]
-                        implemented_stages.append(stage)
-                    except KeyError:
-                        pass
-        return np.unique(implemented_stages)
+    def _likely_files(self):
+        """
+        Returns the paths of all python files and notebooks of the repository, ordered by how likely they contain ml
+        code: training and model scripts and notebooks at the top level first, then shallow files before deep ones.
+        """
+        def priority(filepath):
+            relpath = os.path.relpath(filepath, self.local_dir)
+            depth = relpath.count(os.sep)
+            name = os.path.basename(relpath).lower()
+            if name.startswith(('train', 'model')):
+                kind = 0
+            elif name.endswith('.ipynb'):
+                kind = 1
+            else:
+                kind = 2
+            return min(depth, 1), kind, depth, relpath
 
-    def _process_script(self, filepath: str, functions_to_stages: dict):
-        """Returns a list of ml stages implemented py a python source file."""
+        self.walker = RepoWalker(self.local_dir, self.prune_rules, self.gitignore)
+        return sorted(self.walker.files(('.py', '.ipynb')), key=priority)
 
+    def _inspect_file(self, filepath, prefilter):
+        """Returns the FileAnalysis of a python file or notebook, or None if the file cannot be analyzed."""
         try:
-            with open(filepath, 'r', encoding='utf-8') as source:
-                # Create an abstract syntax tree
-                tree = ast.parse(source.read())
-        except Exception as e:
-            # Expect SyntaxError, FileNotFoundError, PermissionError, OSError and maybe more
-            print(f"{type(e).__name__}. Skipping file")
-            self.skipped_files += 1
-            return[]
+            return self._analyzer.analyze_file(filepath, prefilter)
+        except (OSError, BudgetExceededError):
+            return None
+
+    def _find_first(self, prefilter, found):
+        """
+        Inspects the files in the order of _likely_files until found(analysis) is True. The number of inspected files
+        is stored in self.files_inspected.
+        Returns:    True if a file was found, False if no file matches and None if the time budget of the repository
+                    ran out before.
+        """
+        self.budget.start_repository()
+        self.files_inspected = 0
+        filepaths = self._likely_files()
+        result = False
+        for filepath in filepaths:
+            if self.budget.repo_time_exceeded():
+                self.budget.skip(self.local_dir, 'repo_timeout', elapsed=self.budget.repo_elapsed())
+                result = None
+                break
+            self.files_inspected += 1
+            analysis = self._inspect_file(filepath, prefilter)
+            if analysis is not None and found(analysis):
+                result = True
+                break
+        print("Inspected {} of {} files".format(self.files_inspected, len(filepaths)))
+        return result
+
+    def uses_library(self, library: str):
+        """
+        Determines whether any file of the repository imports the library. Stops at the first file that does.
+        Args:
+            library:    Import prefix of the library, e.g. 'tensorflow' or 'sklearn'.
+        Returns:    True/False, or None if the time budget of the repository ran out before a match.
+        """
+        self._get_analyzer()
+        # Files that do not mention the library are not parsed
+        prefilter = LexicalPrefilter([library], prefix=True)
+        return self._find_first(
+            prefilter, lambda analysis: any(i.startswith(library) for i in analysis.imports))
+
+    def has_stages(self, stages_to_functions, functions_to_stages):
+        """
+        Determines whether any file of the repository implements an ml stage. Stops at the first file that does.
+        Args:
+            stages_to_functions, functions_to_stages:   Mapping function calls to ml stages and vice versa.
+        Returns:    True/False, or None if the time budget of the repository ran out before a match.
+        """
+        self._get_analyzer(functions_to_stages, stages_to_functions)
+        return self._find_first(self.stage_prefilter, lambda analysis: len(analysis.stages) > 0)
+
+    def _walk(self):
+        """Walks the files of the repository like os.walk. Pruned directories and ignored files are left out."""
+        self.walker = RepoWalker(self.local_dir, self.prune_rules, self.gitignore)
+        return self.walker.walk()
+
+    def _get_analyzer(self, functions_to_stages=None, stages=None):
+        """
+        Returns the FileAnalyzer for the given mapping. The analyzer is reused as long as the mapping and the order of
+        the stages (which defines the bits of the stage masks) do not change. Without a mapping, the current analyzer
+        is returned.
+        """
+        analyzer = self._analyzer
+        if analyzer is None or (functions_to_stages is not None and analyzer.functions_to_stages is not functions_to_stages) \
+                or (stages is not None and analyzer.classifier is not None
+                    and analyzer.classifier.stages[:len(list(stages))] != list(stages)):
+            analyzer = FileAnalyzer(
+                functions_to_stages, stages, self.analysis_cache, budget=self.budget)
+            self._analyzer = analyzer
+            if analyzer.stage_prefilter is not None:
+                self.stage_prefilter = analyzer.stage_prefilter
+        return analyzer
 
-        implemented_stages = self._process_ast(tree, functions_to_stages)
-        return implemented_stages
+    def _get_classifier(self, functions_to_stages, stages=None):
+        """Returns the StageClassifier for the given mapping."""
+        return self._get_analyzer(functions_to_stages, stages).classifier
 
-    def get_ml_stages(self, stages_to_functions, functions_to_stages):
+    def analyze_file(self, filepath, functions_to_stages=None):
+        """
+        Parses a python source file once and returns its imports, called functions and ml stages together.
+        Args:
+            filepath:               Path of the python source file.
+            functions_to_stages:    Dictionary mapping function names to ml stages. If omitted, the mapping of previous
+                                    calls is used. Without any mapping the stages are None.
+        Returns:    FileAnalysis(imports, calls, stages)
+        """
+        return self._get_analyzer(functions_to_stages).analyze_file(filepath)
+
+    def _get_stage_mask(self, source, notebook=False, name=None, key=None):
+        """
+        Returns the bitmask of ml stages implemented by a source. Requires that _get_analyzer has been called with a mapping.
+        Args:
+            source:     Content of the file (str or bytes).
+            notebook:   Whether the source is a Jupyter notebook. Notebooks are analyzed cell by cell and results of
+                        unchanged cells are reused.
+            name:       Path of the file, used in skip records.
+            key:        Git blob SHA of the source if it is known. Used as key of the analysis cache.
+        Returns:    Bitmask of ml stages, or None if the notebook cannot be read.
+        """
+        # Files that do not mention any function of the dictionary cannot implement an ml stage
+        if notebook:
+            analysis = self._analyzer.analyze_notebook(source, self.stage_prefilter, name, key)
+        else:
+            analysis = self._analyzer.analyze_source(source, None, self.stage_prefilter, name, key)
+        if analysis is None:
+            return None
+        return self._analyzer.classifier.get_mask(analysis.stages)
+
+    def get_ml_stages(self, stages_to_functions, functions_to_stages, n_processes=1):
         """
         Returns a list of files for each stage of ml workflow.
+        Args:
+            stages_to_functions, functions_to_stages:   Mapping function calls to ml stages and vice versa.
+            n_processes:    Number of processes used to analyze the files of this repository. None means all cores.
+                            Only used for repositories with at least FileAnalyzer.MIN_PARALLEL_FILES source files. Inside
+                            the workers of a regular multiprocessing.Pool the files are analyzed sequentially, use
+                            utilities.parallel.NestablePool for the outer pool instead.
+        Returns:    StageMap. Behaves like the dictionary {stage: [filepath, ...]} and stores one stage bitmask per file.
         """
         # Keeping track of how many files were skipped
         self.skipped_files = 0
-        stages_to_files = {x: []for x in stages_to_functions}
-        # Iterate through all files and determine their stages
-        for root, directories, files in os.walk(self.local_dir):
+        analyzer = self._get_analyzer(functions_to_stages, stages_to_functions)
+        stages_to_files = StageMap(stages_to_functions, self.local_dir)
+        self.budget.start_repository()
+        # Collect all python source files and notebooks. Notebooks are read in-process and never converted on disk.
+        source_files = []
+        for root, directories, files in self._walk():
+            if self.budget.repo_time_exceeded():
+                # The remaining files are not listed, the record names the repository
+                self.budget.skip(self.local_dir, 'repo_timeout', elapsed=self.budget.repo_elapsed())
+                print("Time budget of the repository exceeded. Skipping remaining files")
+                break
             for f in files:
-                # Get the stages implemented by this file
-                filepath = os.path.join(root, f)
-                ml_stages = []
-                # Call _process_script to get the ml stages implemented by this file
-                if (f.endswith('.ipynb')):
-                    # For Jupyter notebooks: Try converting them to .py files first
-                    try:
-                        converted_file_path = self._convert_notebook(filepath)
-                        ml_stages = self._process_script(
-                            converted_file_path, functions_to_stages)
-                    except FileNotReadableError as e:
-                        print(e)
-                elif (f.endswith('.py')):
-                    ml_stages = self._process_script(
-                        filepath, functions_to_stages)
-                # Add files to stages_to files
-                for stage in ml_stages:
-                    stages_to_files[stage].append(filepath)
+                if (f.endswith('.py') or f.endswith('.ipynb')):
+                    source_files.append(os.path.join(root, f))
+
+        # Get the stages implemented by each file
+        stages_per_file = {}
+        analyzed = set()
+        for source_path, ml_stages, error in analyzer.analyze_stages(source_files, n_processes):
+            analyzed.add(source_path)
+            if error is not None:
+                print(f"{error}. Skipping file")
+                self.skipped_files += 1
+            else:
+                stages_per_file[source_path] = ml_stages
+            if self.budget.repo_time_exceeded():
+                # Leaving the loop terminates the pool. Record every file that was not analyzed.
+                elapsed = self.budget.repo_elapsed()
+                for path in source_files:
+                    if path not in analyzed:
+                        self.budget.skip(path, 'repo_timeout', elapsed=elapsed)
+                print("Time budget of the repository exceeded. Skipping remaining files")
+                break
+        # Add the analyzed files with their stages to stages_to_files
+        for filepath in source_files:
+            if filepath in stages_per_file:
+                stages_to_files.add(filepath, analyzer.classifier.get_mask(stages_per_file[filepath]))
 
+        print(self.walker.report())
+        print(self.stage_prefilter.report())
+        print("Tokenized {} sources that were too large or could not be parsed".format(self._analyzer.tokenized))
+        print(self.budget.report())
+        if self.analysis_cache is not None:
+            print(self.analysis_cache.report())
         return stages_to_files
 
-    def get_file_tree(self, tree=None, node=None, path=None):
-        """Create a tree of the file structure. Uses recursion to iterate through the local directory. Parameters are only required in recursive calls."""
-
-        # Initialization
-        if tree is None:
-            tree = Tree()
-            root_name = self.local_dir.split('\\')[-1]
-            node = tree.create_node(root_name, 'root').identifier
-            path = self.local_dir
-        # Base case
-        elif os.path.isfile(path):
-            return tree
-
-        # Iterate through the files in the directory and append them to the tree
-        for i in os.listdir(path):
-            new_node = tree.create_node(i, parent=node)
-            new_path = os.path.join(path, i)
-            tree = self.get_file_tree(tree, new_node, new_path)
-
-        # After appending all subtrees return the resulting tree
+    def get_file_tree(self):
+        """Create a tree of the file structure. Pruned directories and ignored files are left out."""
+
+        tree = Tree()
+        root_name = self.local_dir.split('\\')[-1]
+        # Nodes of the directories by their path
+        nodes = {self.local_dir: tree.create_node(root_name, 'root').identifier}
+
+        # Append the subdirectories and files of each directory to the node of the directory
+        for root, directories, files in self._walk():
+            node = nodes[root]
+            for d in directories:
+                nodes[os.path.join(root, d)] = tree.create_node(d, parent=node).identifier
+            for f in files:
+                tree.create_node(f, parent=node)
+
         return tree
 
-    def _parse_notebook(self, notebook):
-        """Parses a Jupyter notebook into an abstract syntax tree(ast)."""
-        try:
-            notebook_nodes = nbf.reads(notebook, as_version=4)
-        except Exception:
-            # Catch any errors caused by non-readable notebooks
+    def maintain_history(self, repack=None, timing_log=None):
+        """
+        Writes a commit-graph and a multi-pack-index, and repacks the objects if it helps (see GitHistory.maintain), so
+        that later revision walks (get_commit_stages) do not parse every commit object again. Repositories that already
+        have a commit-graph, e.g. from an earlier run, are left as they are.
+        Args:
+            repack:     Force (True) or skip (False) repacking. None repacks only fragmented repositories.
+            timing_log: Optional CSV file. If given, a walk over all commits is timed before and after the maintenance
+                        and a row (repository, steps, seconds before, seconds after) is appended.
+        Returns:    GitHistory.MaintenanceResult, or None if the repository already had a commit-graph.
+        """
+        with GitHistory(self.local_dir) as history:
+            if history.has_commit_graph():
+                return None
+            before = history.time_traversal() if timing_log is not None else None
+            result = history.maintain(repack)
+            after = history.time_traversal() if timing_log is not None else None
+        if timing_log is not None:
+            steps = '|'.join(name for name, done in zip(result._fields, result) if done)
+            write_header = not os.path.exists(timing_log)
+            # One short line per repository, appended by the workers of the pipeline
+            with open(timing_log, 'a', newline='') as f:
+                writer = csv.writer(f)
+                if write_header:
+                    writer.writerow(['repository', 'steps', 'seconds_before', 'seconds_after'])
+                writer.writerow([self.local_dir, steps, before, after])
+        return result
+
+    def _iter_pydriller_commits(self, since=None, until=None, lookup=None):
+        """
+        Generator of (commit SHA, author date, (author name, author email), changed files, cached row) for each commit,
+        read with pydriller. Each changed file is a tuple (filename, versions, lines), versions holds a tuple
+        (load function, path, blob SHA) for the file before and after the commit. Load functions return the source, or
+        None if the version does not exist. lines is a function returning the numbers of added and removed lines.
+        since and until (datetimes) limit the commits by their commit date.
+        lookup is a function (commit SHA) -> row or None. Commits with a row are passed on without their changed files,
+        which are then never diffed.
+        """
+        # Create base class for pydriller
+        self.pyd_repo = pydriller.Repository(self.local_dir, since=since, to=until)
+        for commit in self.pyd_repo.traverse_commits():
+            row = lookup(commit.hash) if lookup is not None else None
+            changes = []
+            if row is None:
+                for file in commit.modified_files:
+                    versions = [(lambda file=file: file.source_code_before, file.old_path, None),
+                                (lambda file=file: file.source_code, file.new_path, None)]
+                    changes.append((file.filename, versions, lambda file=file: (file.added_lines, file.deleted_lines)))
+            yield commit.hash, commit.author_date, (commit.author.name, commit.author.email), changes, row
+
+    @staticmethod
+    def _is_source_change(change):
+        """Returns True if the versions of a changed file (GitHistory.FileChange) are read by get_commit_stages."""
+        return change.old_blob != change.new_blob and (change.new_path or change.old_path).endswith(('.py', '.ipynb'))
+
+    @staticmethod
+    def _read_source(history, blob):
+        """Returns the content of a blob decoded like pydriller's source_code, or None if it is missing or empty."""
+        if blob is None:
             return None
-        trp = TagRemovePreprocessor()
-        trp.remove_cell_tags = ("remove",)
-        pexp = PythonExporter()
-        pexp.register_preprocessor(trp, enabled=True)
-        try:
-            the_python_script, meta = pexp.from_notebook_node(notebook_nodes)
-            return ast.parse(the_python_script)
-        except Exception:
-            # Expect syntax error during parsing or other errors during notebook conversion
+        data = history.read_blob(blob)
+        return data.decode('utf-8', 'ignore') if data else None
+
+    def _iter_git_commits(self, history, revisions=('HEAD',), shas=None, log_args=(), lookup=None):
+        """
+        Like _iter_pydriller_commits, but reads the changed files with 'git log --raw' and loads only the blobs that are
+        analyzed, through one 'git cat-file' process. No diffs are computed. Versions carry their blob SHA.
+        revisions selects the commits like in git log, e.g. ('HEAD', '^<sha>') for the commits not reachable from <sha>.
+        If shas is given, exactly these commits are read instead, in the given order. log_args are passed to git log,
+        lines are only counted with '--numstat'.
+        """
+        if shas is not None:
+            commits = history.iter_listed_commits(shas, log_args)
+        else:
+            commits = history.iter_commits(revisions, log_args)
+        # Look up the rows before the blobs are fetched, blobs of known commits are never needed
+        rows = {}
+        commits = self._lookup_rows(commits, lookup, rows)
+        # In partial clones the blobs of the analyzed versions are fetched in batches
+        for commit in history.prefetching(commits, self._is_source_change):
+            author = (commit.author_name, commit.author_email)
+            row = rows.pop(commit.hash, None)
+            if row is not None:
+                yield commit.hash, commit.author_date, author, [], row
+                continue
+            changes = []
+            for change in commit.changes:
+                lines = partial(lambda change: (change.added, change.removed), change)
+                if change.old_blob == change.new_blob:
+                    # Pure renames and mode changes have no content in pydriller's diffs, keep the results comparable
+                    versions = [(lambda: None, change.old_path, None), (lambda: None, change.new_path, None)]
+                    changes.append((os.path.basename(change.new_path), versions, lines))
+                    continue
+                versions = [(partial(self._read_source, history, change.old_blob), change.old_path, change.old_blob),
+                            (partial(self._read_source, history, change.new_blob), change.new_path, change.new_blob)]
+                changes.append((os.path.basename(change.new_path or change.old_path), versions, lines))
+            yield commit.hash, commit.author_date, author, changes, None
+
+    @staticmethod
+    def _lookup_rows(commits, lookup, rows):
+        """Generator passing on GitCommit tuples. Cached rows are added to rows by SHA, the changes of their commits are dropped."""
+        for commit in commits:
+            row = lookup(commit.hash) if lookup is not None else None
+            if row is not None:
+                rows[commit.hash] = row
+                commit = commit._replace(changes=[])
+            yield commit
+
+    def _commit_cache_functions(self, stages, variant, metrics=(), changes=False):
+        """
+        Returns the functions (lookup, store) reusing rows of commits across repositories through the analysis cache,
+        or (None, None) without a cache. variant names the options the rows depend on. Cached rows are only reused if
+        they contain the columns of all metrics. With changes, only rows with the changed source files are reused, and
+        the rows returned by lookup have them under 'changes' like the changes of _mine_commits, so that a StageLineage
+        can be continued from them. The changes are stored with stage names, the bitmasks depend on the order of stages.
+        """
+        if self.analysis_cache is None:
+            return None, None
+        bits = {stage: 1 << i for i, stage in enumerate(stages)}
+
+        def lookup(sha):
+            row = self.analysis_cache.get_commit(sha, variant, stages, [metric.name for metric in metrics], changes)
+            if row is None:
+                return None
+            new_line = {stage: row[stage] for stage in stages}
+            new_line['time'] = datetime.fromisoformat(row['time'])
+            for metric in metrics:
+                new_line.update(row['metrics'][metric.name])
+            if changes:
+                new_line['changes'] = [
+                    (old_path, new_path, None if names is None else sum(bits[name] for name in names))
+                    for old_path, new_path, names in row['changes']]
+            return new_line
+
+        def store(sha, new_line, metric_columns, lineage_changes):
+            row = {stage: new_line[stage] for stage in stages}
+            row['time'] = new_line['time']
+            row['metrics'] = metric_columns
+            row['changes'] = [
+                (old_path, new_path, None if mask is None else [stage for stage in stages if mask & bits[stage]])
+                for old_path, new_path, mask in lineage_changes]
+            self.analysis_cache.put_commit(sha, row, variant)
+        return lookup, store
+
+    def _get_version_mask(self, version, notebook, masks):
+        """
+        Returns the bitmask of ml stages of one version of a changed file, or None if the version does not exist.
+        masks memorizes the bitmasks by blob SHA: the version before a commit is usually the version after an earlier one.
+        """
+        load, path, blob = version
+        if blob is not None and (blob, notebook) in masks:
+            return masks[blob, notebook]
+        source = load()
+        if source is None:
+            # The file was created or deleted in this commit
             return None
+        stage_mask = self._get_stage_mask(source, notebook, path, blob)
+        if blob is not None:
+            masks[blob, notebook] = stage_mask
+        return stage_mask
 
-    def get_commit_stages(self, functions_to_stages: dict, stages: list):
+    def _create_watermark(self, history, head, stages, fingerprint, masks, metric_names=()):
         """
-        Calculate the number of files in each ml stages affected by each commit.
-        Returns: pd.Dataframe with one row for each commit, one column for each stage and one for the timestamp.
+        Returns the Watermark of the commit head. Stages of its files are taken from the memo of analyzed blobs. Files
+        evicted from the memo are analyzed again, mostly from the analysis cache.
         """
-        # Create list for results
-        result_list = []
-        # Create base class for pydriller
-        self.pyd_repo = pydriller.Repository(self.local_dir)
+        sources = [(path, blob, path.endswith('.ipynb')) for path, blob in history.iter_files(head)
+                   if path.endswith('.py') or path.endswith('.ipynb')]
+        missing = [blob for path, blob, notebook in sources if (blob, notebook) not in masks]
+        if missing and history.promisor_remote() is not None:
+            history.prefetch_blobs(missing)
+        files = {}
+        for path, blob, notebook in sources:
+            try:
+                stage_mask = self._get_version_mask((partial(history.read_blob, blob), path, blob), notebook, masks)
+            except Exception:
+                stage_mask = None
+            # Files that cannot be analyzed (e.g. skipped by the budget) are left out
+            if stage_mask is not None:
+                files[path] = (blob, stage_mask)
+        return Watermark(head, stages, fingerprint, files, metric_names)
 
-        # Iterate through commits
-        for commit in self.pyd_repo.traverse_commits():
-            errors = 0
+    def _mine_commits(self, commits, classifier, stages, masks, store=None, metrics=(), observe=None, branches=None):
+        """
+        Generator counting the files of each ml stage changed by each commit. Yields one row per commit.
+        Args:
+            commits:    Iterable of (commit SHA, author date, author, changed files, cached row) like _iter_git_commits.
+            classifier: StageClassifier of the stages.
+            stages:     Ordered list of the ml stages.
+            masks:      Memo of the stage bitmasks by blob SHA (LRUCache). Filled with the analyzed blobs.
+            store:      Optional function (commit SHA, row, metric columns, changes) caching the rows of mined commits.
+                        Cached rows (from _commit_cache_functions) with changes are passed on to observe.
+            metrics:    commit_metrics.Metric tuples. Their columns are added to the rows.
+            observe:    Optional function (commit SHA, author date, changes) called with the changed source files of each
+                        commit like StageLineage.record, i.e. (old path, new path, stage bitmask of the new version).
+            branches:   Optional dictionary {commit SHA: names of the branches containing it, joined by '|'}, added to
+                        the rows as the column 'branches'.
+        Returns:    True if all commits were mined and not cut by the time budget (the value of yield from)
+        """
+        needs_lines = any(metric.needs_lines for metric in metrics)
+        for sha, author_date, author, changes, row in commits:
+            if self.budget.repo_time_exceeded():
+                self.budget.skip(self.local_dir, 'repo_timeout', elapsed=self.budget.repo_elapsed())
+                print("Time budget of the repository exceeded. Skipping remaining commits")
+                return False
+            if row is not None:
+                # The commit was already mined, e.g. in a copy of this repository
+                changes = row.pop('changes', None)
+                if observe is not None:
+                    observe(sha, author_date, changes)
+                if branches is not None:
+                    row['branches'] = branches.get(sha, '')
+                yield row
+                continue
             # Create a new line for the result-dataframe
             new_line = {stage: 0 for stage in stages}
-            new_line['time'] = commit.author_date
+            new_line['time'] = author_date
+            # Changed files for the metrics and the lineage
+            files = []
+            lineage_changes = []
             # Get ml stages for each modified source file
-            for file in commit.modified_files:
-                # Create ast for scripts and notebooks
-                old_tree = None
-                new_tree = None
-                # Convert and parse notebooks
-                if file.filename.endswith('.ipynb'):
-                    try:
-                        old_tree = self._parse_notebook(
-                            file.source_code_before)
-                    except Exception:
-                        # TypeError occurs if the file was created in this commit
-                        pass
-                    try:
-                        new_tree = self._parse_notebook(
-                            file.source_code)
-                    except Exception:
-                        # TypeError occurs if the file was deleted in this commit
-                        pass
-                # Parse python source files
-                elif file.filename.endswith('.py'):
+            for filename, versions, lines in changes:
+                added, removed = lines() if needs_lines else (None, None)
+                path = versions[1][1] or versions[0][1]
+                # Determine the ml stages of both versions of scripts and notebooks
+                # Sources that cannot be parsed are analyzed with the tokenizer
+                if filename.endswith('.ipynb'):
+                    notebook = True
+                elif filename.endswith('.py'):
+                    notebook = False
+                else:
+                    files.append(ChangedFile(path, None, 0, added, removed))
+                    old_path = versions[0][1]
+                    if old_path is not None and old_path.endswith(('.py', '.ipynb')):
+                        # Renamed to a file that is not analyzed
+                        lineage_changes.append((old_path, None, None))
+                    continue
+                # Stages of both versions are combined into one bitmask
+                version_masks = []
+                for version in versions:
                     try:
-                        old_tree = ast.parse(file.source_code_before)
+                        version_masks.append(self._get_version_mask(version, notebook, masks))
                     except Exception:
-                        # TypeError occurs if the file was created in this commit
-                        pass
-                    try:
-                        new_tree = ast.parse(file.source_code)
-                    except Exception:
-                        # TypeError occurs if the file was deleted in this commit
-                        pass
-
-                # Extract ml stages from ast
-                implemented_stages = None
-                if old_tree is not None and new_tree is not None:
-                    implemented_stages = np.concatenate((self._process_ast(
-                        old_tree, functions_to_stages), self._process_ast(
-                        new_tree, functions_to_stages)))
-                elif new_tree is not None:
-                    implemented_stages = self._process_ast(
-                        new_tree, functions_to_stages)
-                elif old_tree is not None:
-                    implemented_stages = self._process_ast(
-                        old_tree, functions_to_stages)
+                        # Expect budget errors and errors reading the version
+                        version_masks.append(None)
+                stage_mask = (version_masks[0] or 0) | (version_masks[1] or 0)
+                lineage_changes.append((versions[0][1], versions[1][1], version_masks[1]))
 
                 # Append the information from this file to the new line
-                if implemented_stages is not None:
-                    for stage in set(implemented_stages):
-                        new_line[stage] += 1
+                for stage in classifier.get_stages(stage_mask):
+                    new_line[stage] += 1
+                files.append(ChangedFile(path, 'notebook' if notebook else 'script', stage_mask, added, removed))
+
+            # Add the columns of the metrics
+            metric_columns = {}
+            if metrics:
+                record = CommitRecord(sha, author_date, author[0], author[1], stages, files)
+                metric_columns = compute_metrics(record, metrics)
+                for columns in metric_columns.values():
+                    new_line.update(columns)
+
+            if store is not None:
+                store(sha, new_line, metric_columns, lineage_changes)
+            if observe is not None:
+                observe(sha, author_date, lineage_changes)
+            if branches is not None:
+                new_line['branches'] = branches.get(sha, '')
+            yield new_line
+        return True
 
-            # Append the results for this commit to the result-dataframe
-            result_list.append(new_line)
+    def _mine_shards(self, shas, n_shards, stages, masks, log_args=(), variant='', metrics=(), lineage=None,
+                     branches=None, core_budget=None):
+        """
+        Generator splitting the list of commits into contiguous ranges that are mined in parallel by up to n_shards
+        processes. Ranges have at most MAX_SHARD_COMMITS commits. The rows are yielded in the order of the list as the
+        ranges complete. If the time budget cuts a range, the rows of later ranges are left out, like the remaining
+        commits of a sequential run. log_args are passed to git log, variant names the options the rows depend on in
+        the analysis cache, metrics are computed for each commit. The changes of the ranges are recorded in lineage in
+        the order of the list. branches tags the rows like in _mine_commits. Each range starts with an empty memo of
+        stage bitmasks, and the bitmasks it analyzed are merged into masks. At most 2 * n_shards ranges are started and
+        not yet merged, so up to 2 * n_shards * MAX_SHARD_COMMITS rows are held.
+        With a utilities.parallel.CoreBudget, one range runs on the core of this process and further ranges only start
+        on cores reserved from the budget. Cores are reserved again before each range, so cores that other workers
+        free while the history is mined are used as well.
+        Returns:    Tuple (True if all commits were mined, memo of the stage bitmasks of all ranges), the value of
+                    yield from
+        """
+        size = min(-(-len(shas) // n_shards), MAX_SHARD_COMMITS)
+        metric_names = [metric.name for metric in metrics]
+        shards = []
+        for i in range(0, len(shas), size):
+            shard = shas[i:i + size]
+            # Each worker only gets the branch names of its commits
+            shard_branches = {sha: branches.get(sha, '') for sha in shard} if branches is not None else None
+            shards.append((shard, list(log_args), stages, variant, metric_names, lineage is not None, shard_branches))
+        completed = True
+        masks = LRUCache(MAX_MASKS, masks)
+        # Ranges started and not yet merged, in the order of the list, and the cores reserved for running ranges
+        started = []
+        reserved = 0
+        with multiprocessing.Pool(processes=n_shards, initializer=_init_shard_worker,
+                                  initargs=(self.local_dir, self._analyzer)) as pool:
+            try:
+                next_shard = 0
+                while started or next_shard < len(shards):
+                    running = sum(1 for result in started if not result.ready())
+                    if core_budget is not None and reserved > max(0, running - 1):
+                        core_budget.release(reserved - max(0, running - 1))
+                        reserved = max(0, running - 1)
+                    # The first running range uses the core of this process, the others need a reserved one
+                    while next_shard < len(shards) and running < n_shards and len(started) < 2 * n_shards:
+                        if running and core_budget is not None:
+                            if not core_budget.reserve(1):
+                                break
+                            reserved += 1
+                        started.append(pool.apply_async(_mine_shard_worker, (shards[next_shard],)))
+                        next_shard += 1
+                        running += 1
+                    # Wait for the next range in the order of the list, and look for free cores now and then
+                    started[0].wait(timeout=1)
+                    if not started[0].ready():
+                        continue
+                    rows, shard_completed, shard_masks, deltas, skipped, lineage_changes = started.pop(0).get()
+                    # Merge the statistics and skip records of the analyzer copies in the workers
+                    self._analyzer._add_counters(deltas)
+                    self.budget.skipped += skipped
+                    masks.update(shard_masks)
+                    if completed:
+                        for changes in lineage_changes or []:
+                            lineage.record(*changes)
+                        yield from rows
+                    completed = completed and shard_completed
+            finally:
+                if core_budget is not None:
+                    core_budget.release(reserved)
+        return completed, masks
 
-        return pd.DataFrame(result_list)
+    @staticmethod
+    def _walk_options(since=None, until=None, first_parent=False, max_commits=None):
+        """
+        Returns the git log arguments limiting the revision walk, and the arguments changing the output for the
+        selected commits. With first_parent, merge commits are compared with their first parent, so they contain the
+        changes of the merged branch.
+        """
+        def date(value):
+            return value.isoformat() if hasattr(value, 'isoformat') else str(value)
+        walk_args = []
+        if since is not None:
+            walk_args.append('--since=' + date(since))
+        if until is not None:
+            walk_args.append('--until=' + date(until))
+        if first_parent:
+            walk_args.append('--first-parent')
+        if max_commits is not None:
+            walk_args.append('--max-count={}'.format(int(max_commits)))
+        output_args = ['--diff-merges=first-parent'] if first_parent else []
+        return walk_args, output_args
+
+    def iter_commit_stages(self, functions_to_stages: dict, stages: list, engine='git', watermark=None, n_processes=1,
+                           min_shard_commits=MIN_SHARD_COMMITS, since=None, until=None, first_parent=False,
+                           max_commits=None, metrics=(), lineage=None, all_branches=False, core_budget=None,
+                           create_watermark=False):
+        """
+        Generator of the number of files in each ml stages affected by each commit, oldest commit first. Rows are
+        yielded as the commits are mined, so the memory does not grow with the length of the history (with n_processes,
+        up to 2 * n_processes * MAX_SHARD_COMMITS rows are held, see _mine_shards).
+        If the time budget of the repository is exceeded, the remaining commits are left out.
+        Args:
+            functions_to_stages:    Mapping function calls to ml stages.
+            stages:                 Ordered list of the ml stages.
+            engine:     'git' reads the history with git plumbing commands (git log --raw, git cat-file) and analyzes
+                        each blob at most once. 'pydriller' uses pydriller, which computes a diff for every commit.
+                        Both return the same rows.
+            watermark:  Watermark of an earlier run, only supported by the 'git' engine. Only the commits that are not
+                        reachable from the commit of the watermark are mined, stages of unchanged files are reused.
+                        The full history is mined instead if that commit is no ancestor of HEAD anymore (e.g. after a
+                        force push) or the watermark belongs to other stages or another API dictionary.
+            n_processes:        Number of processes mining contiguous ranges of the history ('git' engine only). None
+                                means all cores. Inside the workers of a regular multiprocessing.Pool the history is mined
+                                sequentially, use utilities.parallel.NestablePool for the outer pool instead.
+            min_shard_commits:  Minimum number of commits per range. Shorter histories are mined sequentially.
+            core_budget:        Optional utilities.parallel.CoreBudget shared with other workers. Ranges beyond the
+                                first one only run on cores that are free, see _mine_shards.
+            The following options limit the revision walk itself, so commits outside of the window are never read:
+            since, until:   Only commits with a commit date in this window (datetime, or any date git understands for
+                            the 'git' engine, e.g. '2020-01-01'). The walk stops at the first older commit.
+            first_parent:   Only follow the first parent of merge commits, i.e. the mainline history. Merge commits then
+                            count the files changed by the merged branch. 'git' engine only.
+            max_commits:    Only the max_commits most recent commits of the window, like git log -n. 'git' engine only.
+            metrics:    Names of registered commit metrics (utilities.commit_metrics) computed in the same pass, e.g.
+                        ['author', 'lines_per_stage']. Their columns follow the stage columns and the timestamp.
+            lineage:    StageLineage recording the stage transitions of each source file during the traversal. In
+                        incremental mode it is continued, it has to belong to the commit of the watermark (otherwise
+                        the full history is mined). Else it is cleared first. Commit rows are only reused from the
+                        analysis cache if they were stored with their changed files, which are replayed.
+            all_branches:   Mine the commits of all local and remote-tracking branches instead of HEAD, e.g. experiments
+                            that were never merged. Commits shared by branches are mined once. Each row gets the column
+                            'branches' with the names of the branches containing the commit, joined by '|'. 'git' engine
+                            only, not combined with a watermark.
+            create_watermark:   Create the watermark for the next incremental run ('git' engine). It lists the files at
+                                HEAD, whose stages are analyzed again if they are no longer in the memo. Always done
+                                in incremental mode, i.e. if watermark is given.
+        Yields:  Dictionary for each commit with the number of files of each stage, the timestamp ('time') and the
+                 columns of the metrics. Once the generator is exhausted, self.incremental tells whether only the new
+                 commits were mined and self.watermark holds the watermark for the next run if it was requested, or
+                 None if the time budget cut the history or it was limited by one of the options above.
+        """
+        if engine not in ('git', 'pydriller'):
+            raise ValueError("Unknown engine '{}'. Use 'git' or 'pydriller'.".format(engine))
+        if watermark is not None and engine != 'git':
+            raise ValueError("Incremental mining requires the 'git' engine.")
+        if engine != 'git' and (first_parent or max_commits is not None or all_branches):
+            raise ValueError("first_parent, max_commits and all_branches require the 'git' engine.")
+        if watermark is not None and all_branches:
+            raise ValueError("Incremental mining follows HEAD and cannot be combined with all_branches.")
+        walk_args, output_args = self._walk_options(since, until, first_parent, max_commits)
+        # Rows of commits are reused across repositories through the analysis cache. Merge commits depend on first_parent.
+        variant = 'first-parent' if first_parent else ''
+        if watermark is not None and walk_args:
+            raise ValueError("Incremental mining always covers the full history and cannot be combined with a window.")
+        stages = list(stages)
+        metric_names = list(metrics)
+        metrics = get_metrics(metric_names)
+        if any(metric.needs_lines for metric in metrics):
+            # Count the changed lines in the same git log call
+            output_args = output_args + ['--numstat']
+        classifier = self._get_classifier(functions_to_stages, stages)
+        fingerprint = dictionary_fingerprint(functions_to_stages)
+        lookup, store = self._commit_cache_functions(stages, variant, metrics, lineage is not None)
+        # Bitmasks of the analyzed blobs, bounded so that memory does not grow with the history
+        masks = LRUCache(MAX_MASKS)
+        self.incremental = False
+        self.watermark = None
+        history = None
+        head = None
+        branches = None
+        if engine == 'git':
+            history = GitHistory(self.local_dir)
+            head = history.rev_parse('HEAD')
+            revisions = ('HEAD',) if head is None else (head,)
+            if all_branches:
+                tips = history.list_branches()
+                branches = self._branch_names(history, tips)
+                if tips:
+                    revisions = tuple(sorted({sha for _, sha in tips}))
+            if watermark is not None:
+                if head is not None and watermark.matches(stages, fingerprint, metric_names) \
+                        and (lineage is None or (lineage.head == watermark.head and lineage.stages == stages)) \
+                        and history.is_ancestor(watermark.head, head):
+                    # Mine only the commits since the watermark
+                    self.incremental = True
+                    masks = LRUCache(MAX_MASKS, watermark.masks())
+                    revisions = (head, '^' + watermark.head)
+                else:
+                    print("Watermark does not match the history. Mining the full history")
+        if lineage is not None and not self.incremental:
+            lineage.clear(stages)
+        self.budget.start_repository()
+
+        # Iterate through commits
+        try:
+            n_shards = 1
+            n_processes = get_n_processes(n_processes)
+            if engine == 'git' and n_processes > 1:
+                shas = history.rev_list(revisions, walk_args)
+                n_shards = min(n_processes, len(shas) // max(1, min_shard_commits))
+            if n_shards > 1:
+                completed, masks = yield from self._mine_shards(shas, n_shards, stages, masks, output_args, variant,
+                                                                metrics, lineage, branches, core_budget)
+            else:
+                commits = self._iter_git_commits(history, revisions, log_args=walk_args + output_args, lookup=lookup) \
+                    if engine == 'git' else self._iter_pydriller_commits(since, until, lookup)
+                try:
+                    observe = lineage.record if lineage is not None else None
+                    completed = yield from self._mine_commits(commits, classifier, stages, masks, store, metrics,
+                                                              observe, branches)
+                finally:
+                    commits.close()
+            if completed and head is not None and not walk_args and not all_branches:
+                # The history was mined completely
+                if lineage is not None:
+                    lineage.head = head
+                if create_watermark or watermark is not None:
+                    self.watermark = self._create_watermark(history, head, stages, fingerprint, masks, metric_names)
+            if history is not None and history.fetches:
+                print("Partial clone: fetched {} blobs in {} batches".format(history.fetched_blobs, history.fetches))
+        finally:
+            if history is not None:
+                history.close()
+        self._report_mining()
+
+    @staticmethod
+    def _branch_names(history, tips):
+        """
+        Returns {commit SHA: names of the branches containing the commit, joined by '|'} for the branch tips
+        [(name, SHA), ...]. Commits with the same branches share one string.
+        """
+        masks = history.branch_masks([sha for _, sha in tips])
+        names = {}
+        for mask in set(masks.values()):
+            names[mask] = '|'.join(name for i, (name, _) in enumerate(tips) if mask & (1 << i))
+        return {sha: names[mask] for sha, mask in masks.items()}
+
+    def _report_mining(self):
+        """Prints the statistics of the analyzer, the budget and the cache after mining commits."""
+        print(self.stage_prefilter.report())
+        print(self._analyzer.report())
+        print("Tokenized {} sources that were too large or could not be parsed".format(self._analyzer.tokenized))
+        print(self.budget.report())
+        if self.analysis_cache is not None:
+            print(self.analysis_cache.report())
+
+    def get_commit_stages(self, functions_to_stages: dict, stages: list, **options):
+        """
+        Calculate the number of files in each ml stages affected by each commit. Takes the options of
+        iter_commit_stages. Use iter_commit_stages with utilities.rows_to_csv for long histories.
+        Returns: pd.Dataframe with one row for each commit, one column for each stage and one for the timestamp.
+                 self.incremental and self.watermark are set like by iter_commit_stages.
+        """
+        return pd.DataFrame(list(self.iter_commit_stages(functions_to_stages, stages, **options)))
+
+    def sample_commit_stages(self, functions_to_stages: dict, stages: list, sample_size=None, margin=0.05,
+                             confidence=0.95, n_strata=10, seed=None, since=None, until=None, first_parent=False):
+        """
+        Estimates the proportion of commits changing files of each ml stage from a random sample of the commits, for
+        histories too long to be mined completely. The commits are split by author date into n_strata periods with
+        equal numbers of commits, and each period is sampled in proportion to its size (utilities.sampling). Only the
+        sampled commits are read and analyzed ('git' engine). If the time budget of the repository is exceeded, the
+        estimates are based on the commits mined until then.
+        Args:
+            functions_to_stages:    Mapping function calls to ml stages.
+            stages:                 Ordered list of the ml stages.
+            sample_size:    Number of commits to mine. None chooses it for the margin.
+            margin:         Half width of the confidence intervals to aim for in the worst case, if sample_size is None.
+            confidence:     Confidence level of the intervals.
+            n_strata:       Number of time periods.
+            seed:           Seed of the random sample.
+            since, until, first_parent: Limit the revision walk like in iter_commit_stages.
+        Returns: utilities.sampling.SampledStages with the estimates, the rows of the sampled commits (with the column
+                 'stratum'), the number of commits in the history and the number of commits actually mined.
+        """
+        stages = list(stages)
+        walk_args, output_args = self._walk_options(since, until, first_parent)
+        variant = 'first-parent' if first_parent else ''
+        classifier = self._get_classifier(functions_to_stages, stages)
+        lookup, store = self._commit_cache_functions(stages, variant)
+        with GitHistory(self.local_dir) as history:
+            commits = history.commit_times(('HEAD',), walk_args)
+            # Strata are consecutive periods of time
+            commits.sort(key=lambda commit: commit[1])
+            strata = stratify(len(commits), n_strata)
+            if sample_size is None:
+                sample_size = required_sample_size(len(commits), margin, confidence)
+            sample = draw_sample(strata, sample_size, random.Random(seed))
+            self.budget.start_repository()
+            mined = self._iter_git_commits(history, shas=[commits[i][0] for i, _ in sample], log_args=output_args,
+                                           lookup=lookup)
+            try:
+                rows, completed = _drain(self._mine_commits(mined, classifier, stages, LRUCache(MAX_MASKS), store))
+            finally:
+                mined.close()
+        # Rows are in the order of the sample
+        for row, (_, h) in zip(rows, sample):
+            row['stratum'] = h
+        estimates = estimate_proportions(rows, [len(stratum) for stratum in strata], stages, confidence)
+        self._report_mining()
+        print("Sampled {} of {} commits in {} strata".format(len(rows), len(commits), len(strata)))
+        return SampledStages(estimates, pd.DataFrame(rows), len(commits), len(rows), confidence)
 
-    def get_ml_files(self,stages_to_functions,functions_to_stages):
-        '''Returns a list of files implementing an ml stage.'''
+    def get_ml_files(self,stages_to_functions,functions_to_stages,n_processes=1):
+        '''Returns a list of files implementing an ml stage. n_processes is passed on to get_ml_stages.'''
 
         #Get files implementing an ml stage
-        ml_stages_dict=self.get_ml_stages(stages_to_functions,functions_to_stages)
-        ml_stages_list=[]
-        #Convert the dictionary into a list of files
-        for v in ml_stages_dict.values():
-            ml_stages_list+=v
-        #Remove duplicates
-        ml_stages_set=set(ml_stages_list)
+        stage_map=self.get_ml_stages(stages_to_functions,functions_to_stages,n_processes)
+        #Each file is stored once, with the bitmask of its stages
+        ml_stages_set=set(stage_map.ml_files())
 
         return ml_stages_set
@@ -0,0 +1,183 @@
+import ast
+import keyword
+import tokenize
+from collections import Counter
+
+"""
+Classifies sources into the stages of ml workflow based on the function calls they contain. The calls are extracted
+from abstract syntax trees or, for sources that cannot be parsed, from token streams.
+"""
+
+# Node types that can never contain a function call. Their subtrees are not visited.
+_LEAF_TYPES = frozenset(
+    [ast.Name, ast.Constant, ast.Import, ast.ImportFrom, ast.alias, ast.Pass, ast.Break, ast.Continue, ast.Global,
+     ast.Nonlocal]
+    + ast.expr_context.__subclasses__() + ast.boolop.__subclasses__() + ast.operator.__subclasses__()
+    + ast.unaryop.__subclasses__() + ast.cmpop.__subclasses__())
+# Import statements cannot contain calls either, but they have to be visited to collect the imports
+_NAME_LEAF_TYPES = _LEAF_TYPES - {ast.Import, ast.ImportFrom}
+
+
+def resolve_call_name(node):
+    """
+    Returns the name of the function called by an ast.Call node, or None if it has no simple name.
+    For chained calls like Dense(10)(x) the name of the innermost function is returned.
+    """
+    func = node.func
+    # Unwrap chained calls iteratively
+    while type(func) is ast.Call:
+        func = func.func
+    if type(func) is ast.Attribute:
+        return func.attr
+    if type(func) is ast.Name:
+        return func.id
+    return None
+
+
+def extract_names(tree):
+    """
+    Collects the imported modules and the called function names of a tree in a single traversal.
+    Returns:    Tuple (imports, calls). imports is a list of module names, calls is a Counter of function names.
+    """
+    imports = []
+    calls = Counter()
+    stack = [tree]
+    push = stack.append
+    pop = stack.pop
+    while stack:
+        node = pop()
+        node_type = type(node)
+        if node_type is ast.Call:
+            function_name = resolve_call_name(node)
+            if function_name is not None:
+                calls[function_name] += 1
+        elif node_type is ast.Import:
+            for alias in node.names:
+                imports.append(alias.name)
+            continue
+        elif node_type is ast.ImportFrom:
+            # Append the module from which is imported
+            if node.module is not None:
+                imports.append(node.module)
+            continue
+        for field in node._fields:
+            value = getattr(node, field, None)
+            if type(value) is list:
+                for item in value:
+                    if isinstance(item, ast.AST) and type(item) not in _NAME_LEAF_TYPES:
+                        push(item)
+            elif isinstance(value, ast.AST) and type(value) not in _NAME_LEAF_TYPES:
+                push(value)
+    return imports, calls
+
+
+def extract_names_from_tokens(tokens):
+    """
+    Recovers the imported modules and the called function names from a token stream without building a tree. Used
+    for sources that cannot be parsed (e.g. python 2 code) or are too large to be parsed. Memory use does not depend on
+    the size of the source. A call is a name directly followed by '('. Tokenization errors end the extraction, the
+    names found until then are returned.
+    Args:
+        tokens: Iterator of tokenize.TokenInfo, e.g. tokenize.tokenize(file.readline).
+    Returns:    Tuple (imports, calls) like extract_names.
+    """
+    imports = []
+    calls = Counter()
+    # The last two significant tokens
+    previous = None
+    before_previous = None
+    statement_start = True
+    # 'import' or 'from' while an import statement is read, parts of the current dotted module name
+    import_mode = None
+    module = []
+    skip_alias = False
+    try:
+        for token in tokens:
+            token_type, string = token.type, token.string
+            if token_type in (tokenize.NL, tokenize.COMMENT, tokenize.ENCODING, tokenize.INDENT, tokenize.DEDENT):
+                continue
+            # End of a statement
+            if token_type in (tokenize.NEWLINE, tokenize.ENDMARKER) or (token_type == tokenize.OP and string in (';', ':')):
+                if import_mode == 'import' and module:
+                    imports.append('.'.join(module))
+                import_mode = None
+                module = []
+                statement_start = True
+                previous = before_previous = None
+                continue
+
+            if token_type == tokenize.NAME and statement_start and string in ('import', 'from'):
+                import_mode = string
+                module = []
+                skip_alias = False
+            elif import_mode == 'import':
+                # import a.b as c, d
+                if string == 'as':
+                    skip_alias = True
+                elif string == ',':
+                    if module:
+                        imports.append('.'.join(module))
+                    module = []
+                    skip_alias = False
+                elif token_type == tokenize.NAME and not skip_alias:
+                    module.append(string)
+            elif import_mode == 'from':
+                # from .a.b import c. Leading dots of relative imports are ignored like in the ast.
+                if string == 'import':
+                    if module:
+                        imports.append('.'.join(module))
+                    import_mode = None
+                elif token_type == tokenize.NAME:
+                    module.append(string)
+            elif token_type == tokenize.OP and string == '(' and previous is not None \
+                    and previous.type == tokenize.NAME and not keyword.iskeyword(previous.string) \
+                    and not (before_previous is not None and before_previous.string in ('def', 'class')):
+                calls[previous.string] += 1
+
+            statement_start = False
+            before_previous = previous
+            previous = token
+    except (tokenize.TokenError, SyntaxError, UnicodeDecodeError):
+        # IndentationError is a SyntaxError
+        pass
+    return imports, calls
+
+
+class StageClassifier:
+    """Determines the ml stages implemented by the called functions of a source. Stages are collected in a bitmask."""
+
+    def __init__(self, functions_to_stages: dict, stages=None):
+        """
+        Args:
+            functions_to_stages:    Dictionary mapping function names to ml stages.
+            stages:                 Ordered list of stages. Defines the bit assigned to each stage. Defaults to the
+                                    order in which the stages occur in functions_to_stages.
+        """
+        self.functions_to_stages = functions_to_stages
+        self.stages = list(stages) if stages is not None else []
+        # Make sure that every stage used in the mapping has a bit
+        for stage in functions_to_stages.values():
+            if stage not in self.stages:
+                self.stages.append(stage)
+        self.stage_bits = {stage: 1 << i for i, stage in enumerate(self.stages)}
+        self.function_bits = {function: self.stage_bits[stage]
+                              for function, stage in functions_to_stages.items()}
+
+    def classify_calls(self, calls):
+        """Returns the bitmask of ml stages implemented by a collection of called function names."""
+        function_bits = self.function_bits
+        mask = 0
+        for function_name in calls:
+            mask |= function_bits.get(function_name, 0)
+        return mask
+
+    def get_mask(self, stages):
+        """Returns the bitmask for a list of stage names."""
+        mask = 0
+        for stage in stages:
+            mask |= self.stage_bits[stage]
+        return mask
+
+    def get_stages(self, mask):
+        """Returns the list of stages contained in a bitmask, in the order of self.stages."""
+        return [stage for stage, bit in self.stage_bits.items() if mask & bit]
@@ -0,0 +1,308 @@
+import tempfile
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+
+"""
+Lineage of the ml stages of each source file across the history of a repository, built during the traversal of
+Repository.get_commit_stages. Files are followed across renames. Only transitions are recorded: a file being added,
+renamed or deleted, or the stages of its new version differing from the previous one. File-centric questions (when did
+a file start implementing a stage, how long did a training script live) are then answered without mining again.
+"""
+
+# Kinds of events, like the status letters of git diff
+ADDED = 'A'
+MODIFIED = 'M'
+RENAMED = 'R'
+DELETED = 'D'
+
+# One transition of a file. file is the id of the lineage the event belongs to, stages the stages after the event
+# (empty for deletions).
+LineageEvent = namedtuple('LineageEvent', ['file', 'sha', 'time', 'path', 'kind', 'stages'])
+
+# Events and commits are moved from memory to temporary files once this many events are held in memory
+SPILL_EVENTS = 1 << 16
+
+# Records of the events and commits in the temporary files. Events refer to commits and paths by index.
+EVENT_DTYPE = np.dtype([('file', '<i4'), ('commit', '<i4'), ('path', '<i4'), ('mask', 'u1'), ('kind', 'S1')])
+COMMIT_DTYPE = np.dtype([('sha', 'S20'), ('time', '<i8'), ('offset', '<i2')])
+
+
+def _sha_hex(sha):
+    """Returns the hex SHA of a binary SHA read from an 'S20' array, which drops trailing zero bytes."""
+    return sha.ljust(20, b'\0').hex()
+
+
+class StageLineage:
+    """
+    Append-only table of lineage events. Each commit and path is kept once and events refer to them by index, with a
+    uint8 stage bitmask per event; save writes the columns as numpy arrays. Bit i of a mask stands for self.stages[i].
+    Events must be recorded in the order of the traversal (oldest commit first), so merges of parallel branches are
+    seen in that order as well. Only the last events are kept in memory, earlier ones are appended to temporary files
+    (see SPILL_EVENTS), so the memory used while mining does not grow with the history.
+    """
+
+    def __init__(self, stages, head=None):
+        """
+        Args:
+            stages: Ordered list of stages, at most 8.
+            head:   SHA of the last commit whose changes were recorded.
+        """
+        self.stages = list(stages)
+        if len(self.stages) > 8:
+            raise ValueError("A StageLineage can hold at most 8 stages.")
+        self.head = head
+        # Commits with at least one event, and their author dates as UTC seconds and UTC offsets in minutes
+        self._shas = []
+        self._times = []
+        self._offsets = []
+        # Interned paths
+        self._paths = []
+        self._path_ids = {}
+        # Columns of the events
+        self._files = []
+        self._commits = []
+        self._event_paths = []
+        self._masks = []
+        self._kinds = []
+        # Events and commits moved to temporary files, the lists above hold the later ones
+        self._event_file = None
+        self._commit_file = None
+        self._n_spilled_events = 0
+        self._n_spilled_commits = 0
+        # Files that currently exist: {path: (file id, stage bitmask)}
+        self._live = {}
+        self._n_files = 0
+        self._by_path = None
+
+    def __len__(self):
+        return self._n_spilled_events + len(self._files)
+
+    def clear(self, stages=None):
+        """Removes all events, e.g. before the history is mined again. stages replaces the stages if given."""
+        self.close()
+        self.__init__(self.stages if stages is None else stages)
+
+    def close(self):
+        """Removes the temporary files. The events that were moved there are lost."""
+        for f in (self._event_file, self._commit_file):
+            if f is not None:
+                f.close()
+        self._event_file = self._commit_file = None
+
+    def _tail(self):
+        """Returns the events and commits held in memory as arrays of EVENT_DTYPE and COMMIT_DTYPE."""
+        events = np.empty(len(self._files), dtype=EVENT_DTYPE)
+        events['file'] = self._files
+        events['commit'] = self._commits
+        events['path'] = self._event_paths
+        events['mask'] = self._masks
+        events['kind'] = self._kinds
+        commits = np.empty(len(self._shas), dtype=COMMIT_DTYPE)
+        commits['sha'] = [bytes.fromhex(sha) for sha in self._shas]
+        commits['time'] = self._times
+        commits['offset'] = self._offsets
+        return events, commits
+
+    def _write_spill(self, events, commits):
+        """Appends arrays of events and commits to the temporary files."""
+        if self._event_file is None:
+            self._event_file = tempfile.TemporaryFile()
+            self._commit_file = tempfile.TemporaryFile()
+        self._event_file.write(events.tobytes())
+        self._commit_file.write(commits.tobytes())
+        self._n_spilled_events += len(events)
+        self._n_spilled_commits += len(commits)
+
+    def _spill(self):
+        """Moves the events and commits held in memory to the temporary files."""
+        self._write_spill(*self._tail())
+        for column in (self._shas, self._times, self._offsets, self._files, self._commits, self._event_paths,
+                       self._masks, self._kinds):
+            column.clear()
+
+    @staticmethod
+    def _read_spill(f, dtype, count):
+        if not count:
+            return np.empty(0, dtype=dtype)
+        f.flush()
+        return np.memmap(f, dtype=dtype, mode='r', shape=(count,))
+
+    def _tables(self):
+        """Returns all events and commits as arrays of EVENT_DTYPE and COMMIT_DTYPE, in the order of the traversal."""
+        events, commits = self._tail()
+        if self._event_file is not None:
+            events = np.concatenate([self._read_spill(self._event_file, EVENT_DTYPE, self._n_spilled_events), events])
+            commits = np.concatenate([self._read_spill(self._commit_file, COMMIT_DTYPE, self._n_spilled_commits),
+                                      commits])
+        return events, commits
+
+    def _path_id(self, path):
+        path_id = self._path_ids.get(path)
+        if path_id is None:
+            path_id = self._path_ids[path] = len(self._paths)
+            self._paths.append(path)
+        return path_id
+
+    def _add_event(self, file, path, mask, kind):
+        self._files.append(file)
+        self._commits.append(self._n_spilled_commits + len(self._shas) - 1)
+        self._event_paths.append(self._path_id(path))
+        self._masks.append(mask)
+        self._kinds.append(kind)
+
+    def record(self, sha, time, changes):
+        """
+        Records the changed source files of a commit.
+        Args:
+            sha:        Commit SHA.
+            time:       Author date (timezone-aware datetime).
+            changes:    List of (old path, new path, stage bitmask of the new version). Paths are None for added and
+                        deleted files. The bitmask is None if it is unknown, e.g. for pure renames, then the stages of
+                        the previous version are kept.
+        """
+        n_events = len(self._files)
+        self._shas.append(sha)
+        self._times.append(int(time.timestamp()))
+        self._offsets.append(int(time.utcoffset().total_seconds() // 60) if time.utcoffset() else 0)
+        for old_path, new_path, mask in changes:
+            file, old_mask = self._live.pop(old_path, (None, None)) if old_path is not None else (None, None)
+            if new_path is None:
+                if file is not None:
+                    self._add_event(file, old_path, 0, DELETED)
+                continue
+            if mask is None:
+                mask = old_mask or 0
+            if file is None:
+                # Added, or modified without an earlier event (e.g. from a branch merged later)
+                file = self._n_files
+                self._n_files += 1
+                # A new file at the path of a live one replaces it
+                replaced = self._live.pop(new_path, None)
+                if replaced is not None:
+                    self._add_event(replaced[0], new_path, 0, DELETED)
+                self._add_event(file, new_path, mask, ADDED)
+            elif old_path != new_path:
+                self._add_event(file, new_path, mask, RENAMED)
+            elif mask != old_mask:
+                self._add_event(file, new_path, mask, MODIFIED)
+            self._live[new_path] = (file, mask)
+        if len(self._files) == n_events:
+            # Commits without transitions are not stored
+            self._shas.pop()
+            self._times.pop()
+            self._offsets.pop()
+        self.head = sha
+        self._by_path = None
+        if len(self._files) >= SPILL_EVENTS:
+            self._spill()
+
+    def _event(self, event, commits):
+        """Returns the LineageEvent of a record of EVENT_DTYPE. commits is the table of commits from _tables."""
+        commit = commits[event['commit']]
+        offset = timezone(timedelta(minutes=int(commit['offset'])))
+        mask = int(event['mask'])
+        return LineageEvent(int(event['file']), _sha_hex(commit['sha']),
+                            datetime.fromtimestamp(int(commit['time']), offset), self._paths[event['path']],
+                            event['kind'].decode('ascii'), [stage for j, stage in enumerate(self.stages) if mask & (1 << j)])
+
+    def _file_of(self, path):
+        """Returns the id of the last file that had the path, or None."""
+        if self._by_path is None:
+            events, _ = self._tables()
+            # Later events of a path replace earlier ones
+            self._by_path = dict(zip(events['path'].tolist(), events['file'].tolist()))
+        path_id = self._path_ids.get(path)
+        return self._by_path.get(path_id) if path_id is not None else None
+
+    def history(self, path):
+        """Returns the events of the last file that had the path, including those under its earlier and later paths."""
+        file = self._file_of(path)
+        if file is None:
+            return []
+        events, commits = self._tables()
+        return [self._event(event, commits) for event in events[events['file'] == file]]
+
+    def first_stage(self, path, stage):
+        """Returns the first event after which the file with the path implemented the stage, or None."""
+        if stage not in self.stages:
+            raise ValueError("Unknown stage '{}'.".format(stage))
+        for event in self.history(path):
+            if stage in event.stages:
+                return event
+        return None
+
+    def lifetime(self, path):
+        """Returns (time the file with the path was added, time it was deleted or None if it still exists)."""
+        events = self.history(path)
+        if not events:
+            return None
+        return events[0].time, events[-1].time if events[-1].kind == DELETED else None
+
+    def to_frame(self):
+        """Returns all events as a pd.DataFrame with the columns of LineageEvent, one column per stage instead of stages."""
+        events, commits = self._tables()
+        masks = events['mask']
+        frame = pd.DataFrame({
+            'file': events['file'].astype(np.int64),
+            'sha': [_sha_hex(sha) for sha in commits['sha'][events['commit']]],
+            'time': pd.to_datetime(commits['time'][events['commit']], unit='s', utc=True),
+            'path': [self._paths[i] for i in events['path']],
+            'kind': [kind.decode('ascii') for kind in events['kind']],
+        })
+        for i, stage in enumerate(self.stages):
+            frame[stage] = (masks & (1 << i)) != 0
+        return frame
+
+    def save(self, filepath):
+        """Writes the lineage as a compressed .npz file."""
+        events, commits = self._tables()
+        np.savez_compressed(
+            filepath,
+            stages=np.array(self.stages, dtype=str),
+            head=np.array(self.head or '', dtype=str),
+            shas=commits['sha'],
+            times=commits['time'],
+            offsets=commits['offset'],
+            paths=np.array(self._paths, dtype=str),
+            files=events['file'],
+            commits=events['commit'],
+            event_paths=events['path'],
+            masks=events['mask'],
+            kinds=events['kind'],
+        )
+
+    @classmethod
+    def load(cls, filepath):
+        """
+        Reads a lineage written by save. Returns None if the file does not exist or cannot be read. The events are
+        moved to the temporary files right away, new events are recorded in memory as usual.
+        """
+        try:
+            with np.load(filepath) as data:
+                lineage = cls(data['stages'].tolist(), str(data['head']) or None)
+                events = np.empty(len(data['files']), dtype=EVENT_DTYPE)
+                for field, key in (('file', 'files'), ('commit', 'commits'), ('path', 'event_paths'),
+                                   ('mask', 'masks'), ('kind', 'kinds')):
+                    events[field] = data[key]
+                commits = np.empty(len(data['shas']), dtype=COMMIT_DTYPE)
+                for field, key in (('sha', 'shas'), ('time', 'times'), ('offset', 'offsets')):
+                    commits[field] = data[key]
+                lineage._paths = data['paths'].tolist()
+        except (OSError, ValueError, KeyError):
+            return None
+        lineage._path_ids = {path: i for i, path in enumerate(lineage._paths)}
+        # Files whose last event is no deletion still exist
+        last = {}
+        for i, file in enumerate(events['file'].tolist()):
+            last[file] = i
+        for file, i in last.items():
+            event = events[i]
+            if event['kind'].decode('ascii') != DELETED:
+                lineage._live[lineage._paths[event['path']]] = (file, int(event['mask']))
+        lineage._n_files = int(events['file'].max()) + 1 if len(events) else 0
+        if len(events):
+            lineage._write_spill(events, commits)
+        return lineage
@@ -0,0 +1,115 @@
+import os
+import sys
+from collections import Counter
+from collections.abc import Mapping
+
+import numpy as np
+
+"""
+Compact result of Repository.get_ml_stages: one path per file and one bitmask of ml stages per file.
+"""
+
+# Number of set bits for every uint8 value
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+class StageMap(Mapping):
+    """
+    Maps each ml stage to the list of files implementing it, like the dictionary returned by get_ml_stages before.
+    Internally each file is stored once, as an interned path relative to the repository, together with a uint8 bitmask
+    of its stages. Bit i of a mask stands for self.stages[i]. The lists are views created on access.
+    """
+
+    def __init__(self, stages, root=''):
+        """
+        Args:
+            stages: Ordered list of stages, at most 8.
+            root:   Directory the paths are relative to. Views return the paths joined with root.
+        """
+        self.stages = list(stages)
+        if len(self.stages) > 8:
+            raise ValueError("A StageMap can hold at most 8 stages.")
+        self.root = root
+        self._paths = []
+        self._masks = np.zeros(0, dtype=np.uint8)
+        self._pending = []
+
+    def add(self, filepath, mask):
+        """Adds a file with the bitmask of its stages. Files without stages are kept as well, with mask 0."""
+        relpath = os.path.relpath(filepath, self.root) if self.root else filepath
+        self._paths.append(sys.intern(relpath))
+        self._pending.append(mask)
+
+    @property
+    def masks(self):
+        """Array of the stage bitmasks (uint8), aligned with paths."""
+        if self._pending:
+            self._masks = np.concatenate([self._masks, np.array(self._pending, dtype=np.uint8)])
+            self._pending = []
+        return self._masks
+
+    @property
+    def paths(self):
+        """List of the full paths of all files, including files without stages."""
+        return [self._join(p) for p in self._paths]
+
+    def _join(self, relpath):
+        return os.path.join(self.root, relpath) if self.root else relpath
+
+    def _select(self, selected):
+        """Returns the full paths of the files selected by a boolean array."""
+        return [self._join(self._paths[i]) for i in np.flatnonzero(selected)]
+
+    def __getitem__(self, stage):
+        if stage not in self.stages:
+            raise KeyError(stage)
+        return self._select(self.masks & (1 << self.stages.index(stage)))
+
+    def __iter__(self):
+        return iter(self.stages)
+
+    def __len__(self):
+        return len(self.stages)
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def to_dict(self):
+        """Returns the dictionary {stage: [filepath, ...]}."""
+        return {stage: self[stage] for stage in self.stages}
+
+    def get_mask(self, filepath):
+        """Returns the bitmask of a file, or None if it is not in the map."""
+        relpath = os.path.relpath(filepath, self.root) if self.root else filepath
+        try:
+            return int(self.masks[self._paths.index(relpath)])
+        except ValueError:
+            return None
+
+    def get_stages(self, mask):
+        """Returns the list of stages contained in a bitmask."""
+        return [stage for i, stage in enumerate(self.stages) if mask & (1 << i)]
+
+    def ml_files(self):
+        """Returns the full paths of all files implementing at least one stage."""
+        return self._select(self.masks != 0)
+
+    def n_stages(self):
+        """Returns an array with the number of stages of each file, aligned with paths."""
+        return _POPCOUNT[self.masks]
+
+    def stage_count(self, include_empty=False):
+        """
+        Returns an array whose element n is the number of files implementing exactly n stages.
+        Args:
+            include_empty:  If False, element 0 is 0 instead of the number of files without stages.
+        """
+        count = np.bincount(self.n_stages(), minlength=len(self.stages) + 1)
+        if not include_empty:
+            count[0] = 0
+        return count
+
+    def combinations(self):
+        """Returns a Counter of the combinations of stages implemented together by a file. Keys are tuples of stages."""
+        masks, counts = np.unique(self.masks[self.masks != 0], return_counts=True)
+        return Counter({tuple(self.get_stages(int(m))): int(c) for m, c in zip(masks, counts)})
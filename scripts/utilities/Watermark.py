@@ -0,0 +1,61 @@
+import json
+import os
+
+"""
+Watermark of the incremental mining of commit stages: the last commit whose history was mined, and the ml stages of
+the source files at that commit. A later run only mines the commits that are not reachable from the watermark and
+reuses the stages of the files that did not change since then.
+"""
+
+
+class Watermark:
+    """
+    Last mined commit of a repository and the state of its source files. files maps each .py and .ipynb file at the
+    commit to a tuple (blob SHA, stage bitmask). Bit i of a mask stands for stages[i].
+    """
+
+    def __init__(self, head, stages, fingerprint, files=None, metrics=None):
+        """
+        Args:
+            head:           SHA of the last mined commit.
+            stages:         Ordered list of ml stages the bitmasks refer to.
+            fingerprint:    Fingerprint of the API dictionary (AnalysisCache.dictionary_fingerprint).
+            files:          Dictionary {path: (blob SHA, stage bitmask)}.
+            metrics:        Names of the commit metrics of the mined rows, so that appended rows have the same columns.
+        """
+        self.head = head
+        self.stages = list(stages)
+        self.fingerprint = fingerprint
+        self.files = files or {}
+        self.metrics = list(metrics or [])
+
+    def matches(self, stages, fingerprint, metrics=()):
+        """Returns True if the watermark was created with the same stages, API dictionary and commit metrics."""
+        return self.stages == list(stages) and self.fingerprint == fingerprint and self.metrics == list(metrics)
+
+    def masks(self):
+        """Returns the stage bitmasks by (blob SHA, is notebook), like the memo of Repository.get_commit_stages."""
+        return {(blob, path.endswith('.ipynb')): mask for path, (blob, mask) in self.files.items()}
+
+    @classmethod
+    def load(cls, filepath):
+        """Reads a watermark written by save. Returns None if the file does not exist or cannot be read."""
+        try:
+            with open(filepath, encoding='utf-8') as f:
+                data = json.load(f)
+            return cls(data['head'], data['stages'], data['fingerprint'],
+                       {path: (blob, mask) for path, (blob, mask) in data['files'].items()}, data.get('metrics'))
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def save(self, filepath):
+        """Writes the watermark as JSON. The file is replaced atomically, so an interrupted run keeps the old one."""
+        directory = os.path.dirname(filepath)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        data = {'head': self.head, 'stages': self.stages, 'fingerprint': self.fingerprint,
+                'files': {path: list(value) for path, value in self.files.items()}, 'metrics': self.metrics}
+        tmp_path = filepath + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, filepath)
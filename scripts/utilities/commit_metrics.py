@@ -0,0 +1,78 @@
+from collections import namedtuple
+
+"""
+Per-commit metrics computed during the single traversal of Repository.get_commit_stages. A metric is a function of a
+CommitRecord returning a dictionary of columns that are written next to the stage columns. New metrics are added with
+the register_metric decorator and selected by name, e.g. get_commit_stages(..., metrics=['author', 'n_ml_files']).
+"""
+
+# A file changed by a commit. kind is 'script' or 'notebook' for analyzed files and None for all other files,
+# stage_mask is the bitmask of the stages of both versions (0 for other files). added and removed are the numbers of
+# changed lines, None unless a selected metric needs them.
+ChangedFile = namedtuple('ChangedFile', ['path', 'kind', 'stage_mask', 'added', 'removed'])
+
+# Everything a metric can use. stages are the names of the bits of the stage masks.
+CommitRecord = namedtuple('CommitRecord', ['sha', 'author_date', 'author_name', 'author_email', 'stages', 'files'])
+
+# A registered metric. needs_lines tells the history engines to count added and removed lines (git log --numstat),
+# which reads the blobs of all changed files.
+Metric = namedtuple('Metric', ['name', 'function', 'needs_lines'])
+
+# Registered metrics by name
+METRICS = {}
+
+
+def register_metric(name, needs_lines=False):
+    """
+    Decorator registering a metric function (CommitRecord) -> {column: value}. Values have to be JSON serializable,
+    since rows are cached by commit SHA.
+    Args:
+        name:           Name used to select the metric.
+        needs_lines:    Whether the function uses ChangedFile.added and ChangedFile.removed.
+    """
+    def decorator(function):
+        METRICS[name] = Metric(name, function, needs_lines)
+        return function
+    return decorator
+
+
+def get_metrics(names):
+    """Returns the registered metrics with the given names. Raises ValueError for unknown names."""
+    unknown = [name for name in names if name not in METRICS]
+    if unknown:
+        raise ValueError("Unknown metrics {}. Registered metrics: {}".format(unknown, sorted(METRICS)))
+    return [METRICS[name] for name in names]
+
+
+def compute_metrics(record, metrics):
+    """Returns the columns of each metric for a commit as a dictionary {metric name: {column: value}}."""
+    return {metric.name: metric.function(record) for metric in metrics}
+
+
+@register_metric('lines_per_stage', needs_lines=True)
+def lines_per_stage(record):
+    """Lines added and removed in the files of each stage. Files implementing several stages count for each of them."""
+    columns = {}
+    for i, stage in enumerate(record.stages):
+        files = [f for f in record.files if f.stage_mask & (1 << i)]
+        columns[stage + '_added'] = sum(f.added or 0 for f in files)
+        columns[stage + '_removed'] = sum(f.removed or 0 for f in files)
+    return columns
+
+
+@register_metric('n_ml_files')
+def n_ml_files(record):
+    """Number of changed files implementing at least one stage."""
+    return {'n_ml_files': sum(1 for f in record.files if f.stage_mask)}
+
+
+@register_metric('author')
+def author(record):
+    """Name and email address of the author."""
+    return {'author_name': record.author_name, 'author_email': record.author_email}
+
+
+@register_metric('notebook_only')
+def notebook_only(record):
+    """Whether all files changed by the commit are notebooks. False for commits without changed files."""
+    return {'notebook_only': bool(record.files) and all(f.kind == 'notebook' for f in record.files)}
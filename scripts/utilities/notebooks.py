@@ -0,0 +1,254 @@
+import json
+import mmap
+import os
+import re
+from contextlib import contextmanager
+
+"""
+Extracts the python source code of Jupyter notebooks in-process, without nbconvert and without touching the notebook file.
+The notebook JSON is scanned as a stream: only the type, source and tags of each cell are decoded, outputs, attachments
+and notebook metadata (e.g. widget state) are skipped without being materialized.
+"""
+
+# Cells with one of these tags are left out, like with nbconvert's TagRemovePreprocessor
+REMOVE_CELL_TAGS = ('remove',)
+
+
+def _patterns(kind):
+    """Compiles the patterns used by _NotebookScanner for str or bytes."""
+    def compile(pattern):
+        return re.compile(pattern if kind is str else pattern.encode('ascii'), re.DOTALL)
+    return {
+        'whitespace': compile(r'[ \t\n\r]*'),
+        # Unrolled loop: long runs of ordinary characters are consumed in one step
+        'string': compile(r'"[^"\\]*(?:\\.[^"\\]*)*"'),
+        # Everything up to the next bracket while skipping nested values, including complete strings
+        'plain': compile(r'(?:[^"{}\[\]]+|"[^"\\]*(?:\\.[^"\\]*)*")*'),
+        'scalar': compile(r'[^,}\]\s]*'),
+    }
+
+
+_STR_PATTERNS = _patterns(str)
+_BYTES_PATTERNS = _patterns(bytes)
+
+
+class _NotebookScanner:
+    """
+    Minimal JSON scanner over a str, bytes or mmap. Values are decoded only on request, all other values are skipped
+    by regular expressions. Raises ValueError for malformed JSON.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        is_str = isinstance(data, str)
+        self.patterns = _STR_PATTERNS if is_str else _BYTES_PATTERNS
+        # Structural characters of the matching type
+        self.chars = {c: (c if is_str else c.encode('ascii')) for c in '"{}[]:,'}
+
+    def _char(self, pos):
+        return self.data[pos:pos + 1]
+
+    def _ws(self, pos):
+        return self.patterns['whitespace'].match(self.data, pos).end()
+
+    def _expect(self, pos, char):
+        pos = self._ws(pos)
+        if self._char(pos) != self.chars[char]:
+            raise ValueError("Expected {!r} at position {}".format(char, pos))
+        return pos + 1
+
+    def _skip_string(self, pos):
+        match = self.patterns['string'].match(self.data, pos)
+        if match is None:
+            raise ValueError("Unterminated string at position {}".format(pos))
+        return match.end()
+
+    def skip(self, pos):
+        """Returns the end position of the value starting at pos, without decoding it."""
+        pos = self._ws(pos)
+        char = self._char(pos)
+        chars = self.chars
+        if char == chars['"']:
+            return self._skip_string(pos)
+        if char not in (chars['{'], chars['[']):
+            end = self.patterns['scalar'].match(self.data, pos).end()
+            if end == pos:
+                raise ValueError("Expected a value at position {}".format(pos))
+            return end
+        # Skip nested objects and arrays by counting brackets. Strings are skipped as a whole.
+        depth = 0
+        plain = self.patterns['plain']
+        while True:
+            pos = plain.match(self.data, pos).end()
+            char = self._char(pos)
+            if not char:
+                raise ValueError("Unexpected end of data")
+            if char == chars['"']:
+                pos = self._skip_string(pos)
+                continue
+            if char in (chars['{'], chars['[']):
+                depth += 1
+            else:
+                depth -= 1
+            pos += 1
+            if depth == 0:
+                return pos
+
+    def read(self, pos):
+        """Decodes the value starting at pos. Returns (value, end position)."""
+        pos = self._ws(pos)
+        end = self.skip(pos)
+        return json.loads(self.data[pos:end]), end
+
+    def read_object(self, pos, handlers):
+        """
+        Reads an object and applies a handler to the values of selected keys. Values of other keys are skipped.
+        Args:
+            pos:        Position of the object.
+            handlers:   Dictionary mapping keys to functions (position) -> (value, end position).
+        Returns:    Tuple (dictionary of the handled values, end position)
+        """
+        values = {}
+        pos = self._expect(pos, '{')
+        pos = self._ws(pos)
+        if self._char(pos) == self.chars['}']:
+            return values, pos + 1
+        while True:
+            key, pos = self.read(pos)
+            pos = self._expect(pos, ':')
+            if key in handlers:
+                values[key], pos = handlers[key](pos)
+            else:
+                pos = self.skip(pos)
+            pos = self._ws(pos)
+            char = self._char(pos)
+            if char == self.chars['}']:
+                return values, pos + 1
+            if char != self.chars[',']:
+                raise ValueError("Expected ',' or '}}' at position {}".format(pos))
+            pos += 1
+
+    def read_array(self, pos, handler):
+        """Reads an array and applies the handler (position) -> (value, end position) to each item. Returns (list, end position)."""
+        items = []
+        pos = self._expect(pos, '[')
+        pos = self._ws(pos)
+        if self._char(pos) == self.chars[']']:
+            return items, pos + 1
+        while True:
+            item, pos = handler(pos)
+            items.append(item)
+            pos = self._ws(pos)
+            char = self._char(pos)
+            if char == self.chars[']']:
+                return items, pos + 1
+            if char != self.chars[',']:
+                raise ValueError("Expected ',' or ']' at position {}".format(pos))
+            pos += 1
+
+    def read_optional_object(self, pos, handlers):
+        """Like read_object, but values that are not objects are skipped and returned as an empty dictionary."""
+        if self._char(self._ws(pos)) != self.chars['{']:
+            return {}, self.skip(pos)
+        return self.read_object(pos, handlers)
+
+    def read_cells(self, pos):
+        """Reads an array of cells. Only cell_type, source (input in nbformat 3) and the tags of the metadata are decoded."""
+        cell_handlers = {
+            'cell_type': self.read,
+            'source': self.read,
+            'input': self.read,
+            'metadata': lambda p: self.read_optional_object(p, {'tags': self.read}),
+        }
+        return self.read_array(pos, lambda p: self.read_optional_object(p, cell_handlers))
+
+    def read_notebook(self):
+        """Returns the list of cells of the notebook. Supports nbformat 4 (cells) and nbformat 3 (worksheets)."""
+        handlers = {
+            'cells': self.read_cells,
+            'worksheets': lambda p: self.read_array(p, lambda q: self.read_optional_object(q, {'cells': self.read_cells})),
+        }
+        values, pos = self.read_object(0, handlers)
+        if 'cells' in values:
+            return values['cells']
+        cells = []
+        for worksheet in values.get('worksheets', []):
+            cells += worksheet.get('cells', [])
+        return cells
+
+
+def _cell_source(source):
+    """Returns the source of a cell, which is stored either as one string or as a list of lines."""
+    if isinstance(source, list):
+        return ''.join(s for s in source if isinstance(s, str))
+    return source if isinstance(source, str) else ''
+
+
+def _comment_magics(source):
+    """
+    Comments out IPython syntax that is not valid python. Cells starting with a cell magic (%%) are commented out
+    completely, since their body is usually not python (e.g. %%bash). Line magics (%) and shell commands (!) are
+    commented out line by line.
+    """
+    lines = source.split('\n')
+    if source.lstrip().startswith('%%'):
+        return '\n'.join('# ' + line for line in lines)
+    for i, line in enumerate(lines):
+        if line.lstrip().startswith(('%', '!')):
+            lines[i] = '# ' + line
+    return '\n'.join(lines)
+
+
+def get_code_cells(notebook, remove_cell_tags=REMOVE_CELL_TAGS):
+    """
+    Returns the sources of the code cells of a notebook, without reading outputs or attachments. IPython magics are
+    commented out, so each source is python code on its own.
+    Args:
+        notebook:           Content of the .ipynb file (str, bytes or mmap).
+        remove_cell_tags:   Cells with one of these tags are left out.
+    Returns:    List of the sources of the code cells. Raises ValueError if the notebook is not valid JSON.
+    """
+    try:
+        cells = _NotebookScanner(notebook).read_notebook()
+    except (UnicodeDecodeError, RecursionError) as e:
+        raise ValueError(str(e))
+    sources = []
+    for cell in cells:
+        if cell.get('cell_type') != 'code':
+            continue
+        tags = cell.get('metadata', {}).get('tags', [])
+        if isinstance(tags, list) and any(tag in remove_cell_tags for tag in tags):
+            continue
+        sources.append(_comment_magics(_cell_source(cell.get('source', cell.get('input')))))
+    return sources
+
+
+def notebook_to_python(notebook, remove_cell_tags=REMOVE_CELL_TAGS):
+    """
+    Joins the code cells of a Jupyter notebook into one python script.
+    Args:
+        notebook:           Content of the .ipynb file (str, bytes or mmap).
+        remove_cell_tags:   Cells with one of these tags are left out.
+    Returns:    The python source code, or None if the notebook is not valid JSON.
+    """
+    try:
+        sources = get_code_cells(notebook, remove_cell_tags)
+    except ValueError:
+        # json.JSONDecodeError is a ValueError
+        return None
+    return '\n\n'.join(sources) + '\n'
+
+
+@contextmanager
+def map_notebook(filepath):
+    """
+    Context manager providing the content of a notebook file as a read-only mmap, which can be passed to
+    notebook_to_python. Outputs are skipped on disk and never copied into memory. Empty files are provided as b''.
+    """
+    with open(filepath, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # Empty files cannot be mapped
+            yield b''
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield data
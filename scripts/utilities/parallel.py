@@ -0,0 +1,91 @@
+import os
+import multiprocessing
+import multiprocessing.pool
+
+"""
+Helpers for nesting process pools: per-repository pools in the pipeline scripts and per-file pools inside Repository.
+"""
+
+
+def _non_daemon_context(method=None):
+    """Returns a multiprocessing context whose processes are not daemonic and can therefore start pools of their own."""
+    context = multiprocessing.get_context(method)
+
+    class NonDaemonProcess(context.Process):
+        @property
+        def daemon(self):
+            return False
+
+        @daemon.setter
+        def daemon(self, value):
+            pass
+
+    class NonDaemonContext(type(context)):
+        Process = NonDaemonProcess
+
+    return NonDaemonContext()
+
+
+class NestablePool(multiprocessing.pool.Pool):
+    """
+    multiprocessing.Pool whose workers may create their own pools, e.g. Repository.get_ml_stages(n_processes=...).
+    Workers of a regular Pool are daemonic and are not allowed to have children.
+    """
+
+    def __init__(self, processes=None, *args, **kwargs):
+        kwargs['context'] = _non_daemon_context()
+        super().__init__(processes, *args, **kwargs)
+
+
+class CoreBudget:
+    """
+    Number of cores in use by the workers of a pool and the pools they start, shared between the processes. Create it
+    before the outer pool, so that its workers inherit it. A worker counts its own core with take and reserves cores
+    for a pool of its own with reserve, which only grants cores that are free. Cores of workers that ran out of tasks
+    therefore go to the pools of the workers that are still busy, e.g. with long histories.
+    """
+
+    def __init__(self, n_cores=None):
+        """
+        Args:
+            n_cores:    Number of cores to share. None means all cores.
+        """
+        self.n_cores = n_cores or os.cpu_count() or 1
+        self._used = multiprocessing.Value('i', 0)
+
+    def take(self, n=1):
+        """Counts n cores as used, even if that exceeds the budget (e.g. for the workers of the outer pool)."""
+        with self._used.get_lock():
+            self._used.value += n
+
+    def reserve(self, n):
+        """Reserves up to n of the free cores. Returns the number of cores reserved, possibly 0."""
+        with self._used.get_lock():
+            n = max(0, min(n, self.n_cores - self._used.value))
+            self._used.value += n
+        return n
+
+    def release(self, n=1):
+        """Returns n cores counted by take or reserve."""
+        with self._used.get_lock():
+            self._used.value -= n
+
+
+def cores_per_worker(n_workers):
+    """Returns how many processes each of n_workers outer workers may start without oversubscribing the cores."""
+    return max(1, (os.cpu_count() or 1) // max(1, n_workers))
+
+
+def get_n_processes(n_processes):
+    """
+    Returns the number of processes that can actually be used for a pool inside the current process.
+    Args:
+        n_processes:    Requested number of processes. None means all cores.
+    Returns:    1 inside daemonic pool workers (they cannot have children), otherwise n_processes bounded by the cores.
+    """
+    if multiprocessing.current_process().daemon:
+        return 1
+    cores = os.cpu_count() or 1
+    if n_processes is None:
+        return cores
+    return max(1, min(n_processes, cores))
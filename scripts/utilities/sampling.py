@@ -0,0 +1,135 @@
+import math
+from collections import namedtuple
+from statistics import NormalDist
+
+import pandas as pd
+
+"""
+Stratified random sampling of commits for Repository.sample_commit_stages. The history is split by time into strata of
+consecutive commits, each stratum is sampled in proportion to its size, and the proportion of commits changing each ml
+stage is estimated with the stratified estimator, including the finite population correction. Confidence intervals are
+Wilson score intervals with the effective sample size of the stratified sample, so they do not collapse to a point for
+stages that no sampled commit changed.
+"""
+
+# Result of Repository.sample_commit_stages. estimates has one row per stage with the columns proportion, std_error,
+# lower and upper, rows holds the mined rows of the sampled commits with their stratum.
+SampledStages = namedtuple('SampledStages', ['estimates', 'rows', 'n_commits', 'sample_size', 'confidence'])
+
+
+def _z_score(confidence):
+    return NormalDist().inv_cdf(0.5 + confidence / 2)
+
+
+def required_sample_size(n_commits, margin, confidence=0.95):
+    """
+    Returns the number of commits needed to estimate any proportion within +-margin at the confidence level, for the
+    worst case p=0.5 and with the finite population correction. Proportional stratification does not need more.
+    """
+    n0 = _z_score(confidence) ** 2 * 0.25 / margin ** 2
+    return min(n_commits, math.ceil(n0 / (1 + (n0 - 1) / max(n_commits, 1))))
+
+
+def stratify(n_commits, n_strata):
+    """Splits the indices of the commits (in the order of time) into at most n_strata ranges of nearly equal size."""
+    n_strata = max(1, min(n_strata, n_commits))
+    bounds = [round(k * n_commits / n_strata) for k in range(n_strata + 1)]
+    return [range(bounds[k], bounds[k + 1]) for k in range(n_strata)]
+
+
+def allocate(strata, sample_size):
+    """
+    Returns the number of commits to sample from each stratum. The numbers add up to sample_size. Each stratum gets at
+    least two commits (if it has them), so its variance can be estimated, unless the sample is too small for that. The
+    remaining commits are allocated in proportion to the commits left in each stratum with the largest remainder method.
+    """
+    sizes = [len(stratum) for stratum in strata]
+    if sample_size >= sum(sizes):
+        return sizes
+    counts = [min(size, 2) for size in sizes]
+    if sum(counts) > sample_size:
+        counts = [0] * len(sizes)
+    left = [size - count for size, count in zip(sizes, counts)]
+    remaining = sample_size - sum(counts)
+    # Integer parts and remainders of the quotas remaining * left[h] / sum(left)
+    quotas = [divmod(remaining * n, sum(left)) for n in left]
+    counts = [count + quota for count, (quota, _) in zip(counts, quotas)]
+    # Strata with the largest remainders get one more commit each. A remainder implies that the stratum has one left
+    by_remainder = sorted(range(len(sizes)), key=lambda h: quotas[h][1], reverse=True)
+    for h in by_remainder[:sample_size - sum(counts)]:
+        counts[h] += 1
+    return counts
+
+
+def draw_sample(strata, sample_size, rng):
+    """
+    Draws a stratified random sample without replacement.
+    Args:
+        strata:         Ranges of commit indices from stratify.
+        sample_size:    Total number of commits to draw.
+        rng:            random.Random instance.
+    Returns:    List of (commit index, stratum index) in random order, so that a sample cut short (e.g. by a time
+                budget) is still a random sample of each stratum.
+    """
+    sample = []
+    for h, (stratum, n_h) in enumerate(zip(strata, allocate(strata, sample_size))):
+        sample += [(i, h) for i in rng.sample(stratum, n_h)]
+    rng.shuffle(sample)
+    return sample
+
+
+def estimate_proportions(rows, strata_sizes, stages, confidence=0.95):
+    """
+    Estimates the proportion of commits changing at least one file of each stage.
+    Args:
+        rows:           Rows of the sampled commits with a 'stratum' column, like Repository.get_commit_stages.
+        strata_sizes:   Number of commits in each stratum.
+        stages:         Ordered list of the ml stages.
+        confidence:     Confidence level of the intervals.
+    Returns:    pd.DataFrame with one row per stage and the columns proportion, std_error, lower and upper
+    """
+    z = _z_score(confidence)
+    sampled = {}
+    for row in rows:
+        sampled.setdefault(row['stratum'], []).append(row)
+    columns = ['proportion', 'std_error', 'lower', 'upper']
+    if not sampled:
+        return pd.DataFrame(index=list(stages), columns=columns, dtype=float)
+    # Strata without sampled commits (only if the sample was cut short) are left out, the others are reweighted
+    n_covered = sum(size for h, size in enumerate(strata_sizes) if h in sampled)
+    n_sampled = sum(len(stratum_rows) for stratum_rows in sampled.values())
+    census = all(len(stratum_rows) == strata_sizes[h] for h, stratum_rows in sampled.items())
+    estimates = {}
+    for stage in stages:
+        proportion = variance = 0.0
+        for h, stratum_rows in sampled.items():
+            weight = strata_sizes[h] / n_covered
+            n_h = len(stratum_rows)
+            p_h = sum(1 for row in stratum_rows if row[stage] > 0) / n_h
+            proportion += weight * p_h
+            if n_h > 1:
+                fpc = 1 - n_h / strata_sizes[h]
+                variance += weight ** 2 * fpc * p_h * (1 - p_h) / (n_h - 1)
+        std_error = math.sqrt(variance)
+        if census:
+            # All commits of the covered strata were mined, the proportion is exact
+            lower = upper = proportion
+        else:
+            lower, upper = _wilson_interval(proportion, variance, n_sampled, z)
+        estimates[stage] = {'proportion': proportion, 'std_error': std_error, 'lower': lower, 'upper': upper}
+    return pd.DataFrame.from_dict(estimates, orient='index', columns=columns)
+
+
+def _wilson_interval(proportion, variance, n_sampled, z):
+    """
+    Returns the Wilson score interval (lower, upper) of a stratified proportion. The sample size is replaced by the
+    effective sample size p(1-p)/variance, or by the number of sampled commits if the variance is zero (p is 0 or 1).
+    """
+    p = min(1.0, max(0.0, proportion))
+    n = p * (1 - p) / variance if variance > 0 else n_sampled
+    z2 = z ** 2 / n
+    center = (p + z2 / 2) / (1 + z2)
+    half_width = z / (1 + z2) * math.sqrt(p * (1 - p) / n + z2 / (4 * n))
+    lower = 0.0 if p == 0 else max(0.0, center - half_width)
+    upper = 1.0 if p == 1 else min(1.0, center + half_width)
+    return lower, upper
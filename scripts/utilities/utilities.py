@@ -154,6 +154,38 @@ def list_to_txt_file(lst, file):
     textfile.close()
 
 
+def rows_to_csv(rows, file, chunk_size=1000, append=False):
+    """
+    Writes rows (dictionaries with the same keys, e.g. from Repository.iter_commit_stages) to a CSV file in chunks, so
+    that at most chunk_size rows are held in memory. The file is the same as with pd.DataFrame(rows).to_csv(file,
+    index=False).
+    Args:
+        rows:       Iterable of dictionaries. Columns are in the order of their keys.
+        file:       Path of the CSV file.
+        chunk_size: Number of rows written at once.
+        append:     Append the rows to an existing file, without a header.
+    Returns:    Number of rows written
+    """
+    n_rows = 0
+    chunk = []
+
+    def flush():
+        first = n_rows == 0 and not append
+        pd.DataFrame(chunk).to_csv(file, mode='w' if first else 'a', header=first, index=False)
+
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            flush()
+            n_rows += len(chunk)
+            chunk = []
+    # The header of an empty result is written like by pandas
+    if chunk or (n_rows == 0 and not append):
+        flush()
+        n_rows += len(chunk)
+    return n_rows
+
+
 def safe_api_query(url, auth_params, req_params=None):
     """
     Queries a GitHub API URL and handles the reponse status codes:
@@ -304,12 +336,8 @@ def repo_has_ml_stages(repo_url,stages_to_functions:dict,functions_to_stages:dic
     try:
         #Get mapping of ml stages to modules of the given library
         repo=Repository(repo_url)
-        stages=repo.get_ml_stages(stages_to_functions, functions_to_stages)
-        #Check if there is at least 1 file that uses the specified library
-        for value in stages.values():
-            if len(value) > 0:
-                return True
-        return False
+        #Check if there is at least 1 file that implements an ml stage. Stops at the first one.
+        return repo.has_stages(stages_to_functions, functions_to_stages)
     except ValueError as e:
         #If the repository cannot be cloned return None
         print("An error occured. Skipping repository.")